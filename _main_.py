@@ -1,14 +1,25 @@
 import os
+import re
+import json
+import hashlib
+import itertools
 import math
+import struct
+import numpy as np
+import sys
+import shutil
+import argparse
+import subprocess
+import queue
 from pydub import AudioSegment
-from pydub.playback import _play_with_pyaudio
-import pyaudio
 from datetime import datetime
-import wx
-import array
+from time import perf_counter
 import platform
 import threading
-from mido import Message, MidiFile, MidiTrack
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import OrderedDict
 
 # Definitions
 folders = []
@@ -25,15 +36,27 @@ midi_parameters = [
     "pitch", "velocity", "notelength", "notespacing"
 ]
 
-if platform.system() == "Darwin":
-    ffmpeg_path = os.path.join(os.getcwd(), "mac", "ffmpeg")
-elif platform.system() == "Linux":
-    ffmpeg_path = os.path.join(os.getcwd(), "linux", "ffmpeg")
-elif platform.system() == "Windows":
-    ffmpeg_path = os.path.join(os.getcwd(), "windows", "ffmpeg.exe")
-else:
-    raise Exception("Unsupported OS")
-
+# Where ffmpeg is bundled, per OS
+bundled_ffmpeg = {
+    "Darwin": os.path.join("mac", "ffmpeg"),
+    "Linux": os.path.join("linux", "ffmpeg"),
+    "Windows": os.path.join("windows", "ffmpeg.exe"),
+}
+
+def find_ffmpeg():
+    """Return $DEINING_FFMPEG, the bundled ffmpeg or the one on the PATH."""
+    if os.environ.get("DEINING_FFMPEG"):
+        return os.environ["DEINING_FFMPEG"]
+    bundled = bundled_ffmpeg.get(platform.system())
+    if bundled:
+        # Next to this file first, so renders don't depend on the working directory
+        for base in (os.path.dirname(os.path.abspath(__file__)), os.getcwd()):
+            path = os.path.join(base, bundled)
+            if os.path.isfile(path):
+                return path
+    return shutil.which("ffmpeg") or "ffmpeg"
+
+ffmpeg_path = find_ffmpeg()
 AudioSegment.converter = ffmpeg_path
 
 class AudioFolder:
@@ -53,10 +76,105 @@ class AudioFolder:
         }
 
 
+    def sample_paths(self):
+        if not self.path:
+            return []
+        return [os.path.join(self.path, file) for file in os.listdir(self.path) if file.endswith('.wav')]
+
     def load_audio_files(self):
-        if self.path:
-            file_paths = [os.path.join(self.path, file) for file in os.listdir(self.path) if file.endswith('.wav')]
-            self.audio_files = [AudioSegment.from_wav(f) for f in file_paths]
+        """Load every sample, decoding them concurrently; returns the files that were skipped, see FolderLoader."""
+        loader = FolderLoader(self).start()
+        loader.wait()
+        return loader.errors
+
+# Threads sample files are decoded on while a folder loads; mostly waiting on the disk, so more than the cores
+load_workers = min(32, (os.cpu_count() or 1) + 4)
+
+class FolderLoader:
+    """Loads the samples of an AudioFolder on a thread pool.
+
+    Files are decoded concurrently. As they come in, folder.audio_files is
+    replaced with every sample that's ready so far, in file order, so the
+    folder can be played before it's done; renders keep the list they
+    started with. Files that can't be read are skipped and listed in errors
+    as (path, message). on_progress(done, total) and on_finish(loader) are
+    called from the loading threads. A cancelled load keeps the samples it
+    has.
+    """
+
+    def __init__(self, folder, on_progress=None, on_finish=None, workers=None):
+        self.folder = folder
+        self.paths = folder.sample_paths()
+        self.samples = [None] * len(self.paths)
+        self.errors = []
+        self.done = 0
+        self.on_progress = on_progress
+        self.on_finish = on_finish
+        self.workers = workers or load_workers
+        self.lock = threading.Lock()
+        self.cancelled = threading.Event()
+        self.finished = threading.Event()
+        self.executor = None
+        self.published = 0.0
+
+    def start(self):
+        self.folder.audio_files = []
+        if not self.paths:
+            self.finish()
+            return self
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        for index, path in enumerate(self.paths):
+            self.executor.submit(self.load, index, path).add_done_callback(self.file_done)
+        self.executor.shutdown(wait=False)
+        return self
+
+    def load(self, index, path):
+        if self.cancelled.is_set():
+            return
+        try:
+            sample = load_sample(path)
+        except Exception as error:
+            with self.lock:
+                self.errors.append((path, f"{type(error).__name__}: {error}"))
+            return
+        with self.lock:
+            self.samples[index] = sample
+            # Publishing copies the list, so not more often than every 100 ms
+            if perf_counter() - self.published > 0.1:
+                self.publish()
+
+    def publish(self):
+        self.folder.audio_files = [sample for sample in self.samples if sample is not None]
+        self.published = perf_counter()
+
+    def file_done(self, future):
+        # Also called for files cancelled before they started
+        with self.lock:
+            self.done += 1
+            done = self.done
+        if self.on_progress is not None:
+            self.on_progress(done, len(self.paths))
+        if done == len(self.paths):
+            self.finish()
+
+    def finish(self):
+        with self.lock:
+            self.publish()
+        self.finished.set()
+        if self.on_finish is not None:
+            self.on_finish(self)
+
+    def cancel(self):
+        """Stop loading; files already being decoded are finished and kept."""
+        self.cancelled.set()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def wait(self, timeout=None):
+        return self.finished.wait(timeout)
+
+    def progress(self):
+        return self.done, len(self.paths)
 
 class MidiFolder:
     def __init__(self):
@@ -69,551 +187,2788 @@ class MidiFolder:
             # Add more MIDI parameters here
         }
 
-def generate_midi_based_on_formula(duration_in_millis, all_folders, filename):
-    mid = MidiFile()
-    track = MidiTrack()
-    mid.tracks.append(track)
-
-    t_millis = 0
-    
-    while t_millis < duration_in_millis:
-        # Use your existing formulas to determine MIDI parameters
-        if "pitch" in current_folder.formulas:
-            pitch = int(evaluate_formula(current_folder.formulas["pitch"], t_millis, all_folders))
-        else:
-            pitch = 60
-
-        if "velocity" in current_folder.formulas:
-            velocity = int(evaluate_formula(current_folder.formulas["velocity"], t_millis, all_folders))
-        else:
-            velocity = 60
-
-        if "notelength" in current_folder.formulas:
-            notelength = int(evaluate_formula(current_folder.formulas["notelength"], t_millis, all_folders))
-        else:
-            notelength = 100
-
-        if "notespacing" in current_folder.formulas:
-            notespacing = int(evaluate_formula(current_folder.formulas["notespacing"], t_millis, all_folders))
-        else:
-            notespacing = 100
-
-        # Add MIDI events
-        track.append(Message('note_on', note=pitch, velocity=velocity, time=0))
-        track.append(Message('note_off', note=pitch, velocity=velocity, time=notelength))
+sample_uids = itertools.count()
 
-        # Update time
-        t_millis += notespacing
+class Sample:
+    """Decoded PCM of one sample file as a read-only (frames, channels) array.
 
-    # Save the MIDI file
-    mid.save(f"./exports/{filename}")
+    Long samples are usually a memory map of the sample library's cache, so
+    grains are sliced straight out of the mapped pages without copying.
+    """
 
-def get_evaluation_order(folder):
-    """Return a list of formula names in the order they should be evaluated."""
-    remaining = set(folder.formulas.keys())  # Use the formulas from the passed-in folder
-    order = []
-    while remaining:
-        for formula_name in list(remaining):
-            if not get_dependencies(folder.formulas[formula_name]).difference(order):
-                order.append(formula_name)
-                remaining.remove(formula_name)
-    return order
-
-# Functions
-def get_evaluation_context(t_millis, all_folders):
-    x_value = t_millis / 1000
-    context = {"x": x_value}
-    
-    for i, folder in enumerate(all_folders):
-        evaluation_order = get_evaluation_order(folder)
-        for formula_name in evaluation_order:
-            formula = folder.formulas[formula_name]
-            context[f"{i+1}.{formula_name}"] = simple_evaluate(formula, x_value, context)
-    
-    return context
-
-
-def multiplier_to_db(multiplier):
-    return 20 * math.log10(multiplier)
-
-def get_audio_for_time(audios, formula, t_millis):
-    y = eval(formula.replace('x', str(t_millis / 1000)))
-    index = int(y) % len(audios)
+    def __init__(self, samples, frame_rate, path=None, cache_path=None):
+        self.samples = samples
+        self.frame_rate = frame_rate
+        self.sample_width = samples.dtype.itemsize
+        self.channels = samples.shape[1]
+        self.path = path
+        self.cache_path = cache_path
+        # Identifies the sample in caches of derived material
+        self.uid = next(sample_uids)
+
+    @classmethod
+    def from_segment(cls, audio, path=None):
+        return cls(segment_samples(audio), audio.frame_rate, path)
+
+    def __len__(self):
+        # Length in milliseconds, like AudioSegment
+        return round(1000 * (len(self.samples) / self.frame_rate))
+
+    def frame_at(self, position):
+        if position < 0:
+            position = len(self) - abs(position)
+        return int(position * (self.frame_rate / 1000.0))
+
+    def millis_to_frames(self, start, end):
+        """Return the frame range of positions in ms, like AudioSegment[start:end] would."""
+        return self.frame_at(min(start, len(self))), self.frame_at(min(end, len(self)))
+
+    def to_segment(self, samples, frame_rate=None):
+        """Wrap samples in this sample's format into an AudioSegment."""
+        return AudioSegment(data=np.ascontiguousarray(samples).tobytes(), sample_width=self.sample_width, frame_rate=frame_rate or self.frame_rate, channels=self.channels)
+
+# Cache files smaller than this are read into memory instead of mapped. Every
+# memory map keeps a file descriptor open, so a folder of a few hundred
+# mapped samples runs into the open file limit (256 by default on macOS).
+mmap_min_bytes = 16 * 1024 * 1024
+
+def open_cached_samples(cache_path):
+    if os.path.getsize(cache_path) >= mmap_min_bytes:
+        try:
+            return np.load(cache_path, mmap_mode="r")
+        except ValueError:
+            pass  # Empty samples can't be mapped
+    samples = np.load(cache_path)
+    samples.setflags(write=False)
+    return samples
+
+class SampleLibrary:
+    """On-disk cache of decoded sample files.
+
+    Decoded PCM is stored as .npy files keyed by the source path, mtime and
+    size, so every file is only decoded once. Files of at least mmap_min_bytes
+    are opened as read-only memory maps, so long samples don't have to fit in
+    RAM and render worker processes share their pages; shorter ones are read
+    into memory so they don't each hold a file descriptor open. With
+    max_bytes set, the least recently used files are evicted whenever the
+    cache grows past it.
+    """
+
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def cache_key(self, path):
+        stat = os.stat(path)
+        identity = f"{os.path.abspath(path)}|{stat.st_mtime_ns}|{stat.st_size}"
+        return hashlib.sha1(identity.encode()).hexdigest()
+
+    def load(self, path):
+        started = perf_counter() if render_stats.enabled else None
+        cache_base = os.path.join(self.cache_dir, self.cache_key(path))
+        try:
+            with open(cache_base + ".json") as info_file:
+                info = json.load(info_file)
+            samples = open_cached_samples(cache_base + ".npy")
+            os.utime(cache_base + ".npy")  # Mark as recently used
+            stage = "load"
+        except (OSError, ValueError):
+            info, samples = self.store(path, cache_base)
+            stage = "decode"
+        if started is not None:
+            render_stats.record(stage, perf_counter() - started, samples.nbytes)
+        return Sample(samples, info["frame_rate"], path, cache_base + ".npy")
+
+    def store(self, path, cache_base):
+        audio = AudioSegment.from_wav(path)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        info = {"path": os.path.abspath(path), "frame_rate": audio.frame_rate}
+        # Write to temporary files first so other processes never see half a file,
+        # named per thread as loader threads can decode the same file at once
+        temp_suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(cache_base + ".npy" + temp_suffix, "wb") as data_file:
+            np.save(data_file, segment_samples(audio))
+        os.replace(cache_base + ".npy" + temp_suffix, cache_base + ".npy")
+        with open(cache_base + ".json" + temp_suffix, "w") as info_file:
+            json.dump(info, info_file)
+        os.replace(cache_base + ".json" + temp_suffix, cache_base + ".json")
+        if self.max_bytes is not None:
+            self.evict(self.max_bytes, keep=cache_base + ".npy")
+        return info, open_cached_samples(cache_base + ".npy")
+
+    def size(self):
+        return sum(os.path.getsize(p) for p in self.cache_files())
+
+    def cache_files(self):
+        if not os.path.isdir(self.cache_dir):
+            return []
+        return [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir) if name.endswith(".npy")]
+
+    def evict(self, max_bytes, keep=None):
+        """Delete least recently used cache files until the cache fits in max_bytes."""
+        entries = []
+        for data_path in self.cache_files():
+            stat = os.stat(data_path)
+            entries.append((stat.st_mtime, stat.st_size, data_path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, data_path in entries:
+            if total <= max_bytes:
+                break
+            if data_path == keep:
+                continue
+            try:
+                os.remove(data_path)
+                os.remove(data_path[:-len(".npy")] + ".json")
+            except OSError:
+                continue  # Still mapped somewhere (Windows), try the next one
+            total -= size
+
+# Decoded samples are cached here; set to None to decode into memory instead
+sample_library = SampleLibrary(os.path.join(os.getcwd(), "cache", "samples"))
+
+def load_sample(path):
+    if sample_library is not None:
+        return sample_library.load(path)
+    return Sample.from_segment(AudioSegment.from_wav(path), path)
+
+# MIDI files tick once per millisecond: 500 ticks per beat at 120 bpm
+midi_ticks_per_beat = 500
+midi_tempo = 500000  # Microseconds per beat
+
+def generate_midi_based_on_formula(duration_in_millis, all_folders, filename, folders=None):
+    """Write the notes of MIDI folders to a format 1 MIDI file, one track and channel per folder.
+
+    folders defaults to every folder in all_folders. Relative file names go
+    to the exports folder. The file is written while the notes are
+    evaluated, a batch at a time, so memory doesn't grow with its length.
+    """
+    plan = get_formula_plan(all_folders)
+    if folders is None:
+        folders = all_folders
+    path = os.path.join("./exports", filename)
+    tempo_track = [b"\x00\xff\x51\x03" + midi_tempo.to_bytes(3, "big")]
+    tracks = [tempo_track]
+    for channel, folder in enumerate(folders):
+        tracks.append(iter_midi_track(plan, all_folders.index(folder), duration_in_millis, channel % 16, f"MIDI {channel + 1}"))
+    write_midi_file(path, tracks)
+    return path
+
+def write_midi_file(path, tracks):
+    """Stream a format 1 MIDI file, tracks being iterables of encoded events."""
+    with open(path, "wb") as midi_file:
+        midi_file.write(b"MThd" + struct.pack(">IHHH", 6, 1, len(tracks), midi_ticks_per_beat))
+        for track in tracks:
+            midi_file.write(b"MTrk\x00\x00\x00\x00")
+            track_start = midi_file.tell()
+            for events in track:
+                midi_file.write(events)
+            midi_file.write(b"\x00\xff\x2f\x00")  # End of track
+            # The chunk length is only known now
+            track_end = midi_file.tell()
+            midi_file.seek(track_start - 4)
+            midi_file.write(struct.pack(">I", track_end - track_start))
+            midi_file.seek(track_end)
+
+def iter_midi_track(plan, folder_index, duration_in_millis, channel, name):
+    """Yield the encoded events of a MIDI folder's track, a notespacing batch at a time.
+
+    A note that's retriggered while it's still sounding ends where the new
+    one starts. Note offs that fall after the batch wait for later batches,
+    so every event is written in time order with the right delta.
+    """
+    name = name.encode()
+    yield b"\x00\xff\x03" + bytes([len(name)]) + name
+    no_note = np.iinfo(np.int64).max
+    # Note offs not written yet: time, onset, pitch, velocity
+    pending = [np.zeros(0, dtype=np.int64)] * 4
+    last_time = 0
+    for onsets, values in iter_grain_batches(plan, folder_index, duration_in_millis, "notespacing", notespacing_to_millis):
+        count = len(onsets)
+        pitches = midi_column(values, "pitch", 60, count)
+        velocities = midi_column(values, "velocity", 60, count)
+        lengths = np.maximum(np.trunc(values["notelength"]), 0).astype(np.int64) if "notelength" in values else np.full(count, 100)
+        offs = onsets + lengths
+
+        # The next onset of the same pitch ends a note, within this batch...
+        order = np.lexsort((onsets, pitches))
+        same_pitch = pitches[order[1:]] == pitches[order[:-1]]
+        next_onsets = np.full(count, no_note)
+        next_onsets[order[:-1][same_pitch]] = onsets[order[1:][same_pitch]]
+        offs = np.minimum(offs, next_onsets)
+        # ...and the ones still sounding from earlier batches
+        first_onsets = np.full(128, no_note)
+        np.minimum.at(first_onsets, pitches, onsets)
+        pending[0] = np.minimum(pending[0], first_onsets[pending[2]])
+
+        pending = [np.concatenate(column) for column in zip(pending, (offs, onsets, pitches, velocities))]
+        # Later batches start after this one's last onset, so everything up to it is final
+        ready = pending[0] <= onsets[-1]
+        events, last_time = encode_midi_notes(onsets, pitches, velocities, *(column[ready] for column in pending), channel, last_time)
+        pending = [column[~ready] for column in pending]
+        yield events
+
+    events, _ = encode_midi_notes(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), *pending, channel, last_time)
+    yield events
+
+def midi_column(values, formula_name, default, count):
+    if formula_name not in values:
+        return np.full(count, default, dtype=np.int64)
+    # Truncated like int() did, and kept in the 0-127 range MIDI allows
+    return np.clip(np.trunc(values[formula_name]), 0, 127).astype(np.int64)
+
+def encode_midi_notes(onsets, pitches, velocities, off_times, off_onsets, off_pitches, off_velocities, channel, last_time):
+    """Encode note ons and offs in time order, returns (bytes, time of the last event).
+
+    At the same time, notes end before new ones start, except notes that
+    are zero length, which end right after they start.
+    """
+    times = np.concatenate([off_times, onsets])
+    kinds = np.concatenate([np.where(off_onsets < off_times, 0, 2), np.ones(len(onsets), dtype=np.int64)])
+    statuses = np.concatenate([np.full(len(off_times), 0x80 | channel), np.full(len(onsets), 0x90 | channel)])
+    notes = np.concatenate([off_pitches, pitches])
+    note_velocities = np.concatenate([off_velocities, velocities])
+    order = np.lexsort((kinds, times))
+    times = times[order]
+    if not len(times):
+        return b"", last_time
+    deltas = np.diff(times, prepend=last_time)
+    return encode_midi_events(deltas, statuses[order], notes[order], note_velocities[order]), int(times[-1])
+
+def encode_midi_events(deltas, statuses, data1, data2):
+    """Encode three byte channel messages with their variable length delta times."""
+    if deltas.max() >= 1 << 28:
+        raise ValueError("MIDI delta times can't be longer than 2^28 ticks")
+    rows = np.empty((len(deltas), 7), dtype=np.uint8)
+    for column, shift in enumerate((21, 14, 7, 0)):
+        rows[:, column] = (deltas >> shift) & 0x7f
+    rows[:, :3] |= 0x80  # More bytes follow
+    rows[:, 4] = statuses
+    rows[:, 5] = data1
+    rows[:, 6] = data2
+    # Keep only as many delta bytes as the delta needs
+    delta_lengths = 1 + (deltas >= 1 << 7) + (deltas >= 1 << 14) + (deltas >= 1 << 21)
+    keep = np.ones((len(deltas), 7), dtype=bool)
+    keep[:, :4] = np.arange(4) >= (4 - delta_lengths)[:, None]
+    return rows[keep].tobytes()
+
+def get_audio_for_time(audios, sample_value):
+    index = int(sample_value) % len(audios)
     return audios[index]
 
 
 
 def time_playback_speed(audio, playback_speed_factor):
-    """Time-playback_speed an audio segment by the given factor using pydub."""
-    if playback_speed_factor < 0:
-        audio = audio.reverse()
-        playback_speed_factor = abs(playback_speed_factor)
-        
-    playback_speeded_audio = audio._spawn(audio.raw_data, overrides={
-        "frame_rate": int(audio.frame_rate * playback_speed_factor)
-    }).set_frame_rate(audio.frame_rate)
-    return playback_speeded_audio
-
-def evaluate_formula(formula, t_millis, all_folders):
-    context = get_evaluation_context(t_millis, all_folders)
-    return eval(formula, {}, context)
-
-def pan_audio(audio, pan_value):
-    """Pan an audio segment based on the given pan value (-1 to 1)."""
-    if pan_value < -1: pan_value = -1
-    if pan_value > 1: pan_value = 1
-
-    # Calculate the gain adjustments for left and right channels
-    if pan_value == -1:
-        left_gain = 0  # No change in dB
-        right_gain = -float('inf')  # Mute
-    elif pan_value == 1:
-        left_gain = -float('inf')  # Mute
-        right_gain = 0  # No change in dB
-    else:
-        # For pan_value between -1 and 1, we adjust the balance without muting
-        left_gain = (1 - pan_value) / 2  # This will range from 0.5 (for pan_value=-1) to 1 (for pan_value=1)
-        right_gain = (1 + pan_value) / 2  # This will range from 1 (for pan_value=-1) to 0.5 (for pan_value=1)
+    """Time-playback_speed an audio segment by the given factor.
 
-    # Convert gains to dB for application
-    left_gain_db = 20 * math.log10(left_gain)
-    right_gain_db = 20 * math.log10(right_gain)
+    For library use, the render paths resample Sample buffers directly.
+    """
+    sample = Sample.from_segment(audio)
+    frames = resampler.grain(sample, 0, len(sample.samples), playback_speed_factor, audio.frame_rate)
+    return sample.to_segment(frames.astype(sample.samples.dtype))
 
-    # Split the stereo audio into left and right channels
-    channels = audio.split_to_mono()
-    left_channel = channels[0].apply_gain(left_gain_db)
-    right_channel = channels[1].apply_gain(right_gain_db)
+class ScratchPool:
+    """Reusable scratch buffers for the grain loop.
 
-    # Combine the adjusted channels back into stereo
-    panned_audio = AudioSegment.from_mono_audiosegments(left_channel, right_channel)
-    return panned_audio
+    Buffers grow to the largest grain seen so far and get() hands out views of
+    them, so once the pool has warmed up the render loop doesn't allocate per
+    grain. A view is only valid until the next get() with the same name.
+    """
+
+    def __init__(self):
+        self.buffers = {}
+
+    def get(self, name, shape, dtype=np.float32):
+        buffer_key = (name, shape[1:], np.dtype(dtype))
+        buffer = self.buffers.get(buffer_key)
+        if buffer is None or len(buffer) < shape[0]:
+            buffer = np.empty((max(shape[0], 1024),) + shape[1:], dtype=dtype)
+            self.buffers[buffer_key] = buffer
+        return buffer[:shape[0]]
+
+    def ramp(self, count):
+        """Return a view of 0.0, 1.0, ... count - 1."""
+        ramp = self.buffers.get("ramp")
+        if ramp is None or len(ramp) < count:
+            ramp = np.arange(max(count, 1024), dtype=np.float64)
+            self.buffers["ramp"] = ramp
+        return ramp[:count]
+
+# One pool per thread, preview and export can render at the same time
+scratch_pools = threading.local()
+
+def get_scratch_pool():
+    pool = getattr(scratch_pools, "pool", None)
+    if pool is None:
+        pool = scratch_pools.pool = ScratchPool()
+    return pool
+
+def gather_frames(source, indices, out, scratch):
+    """Fill out with source[indices], out of range indices reading as silence.
+
+    indices must be sorted, which they are for any resampling position grid.
+    """
+    np.take(source, indices, axis=0, out=scratch, mode="clip")
+    np.copyto(out, scratch, casting="unsafe")
+    out[:np.searchsorted(indices, 0)] = 0
+    out[np.searchsorted(indices, len(source)):] = 0
+    return out
+
+def resample_region(source, start_frame, end_frame, step, pool=None):
+    """Resample source[start_frame:end_frame] by linear interpolation, `step` source frames per output frame.
+
+    Output frames sit at source positions j * step for every whole j in the
+    region, so the result is exactly the matching slice of resampling the
+    whole source. Only the region plus one frame of padding is read. When
+    step is 1 the result is a view of source itself; otherwise it's float32
+    and, with a pool, a view of its scratch buffers.
+    """
+    pool = pool or ScratchPool()
+    first = math.ceil(start_frame / step)
+    count = math.ceil(end_frame / step) - first
+    channels = source.shape[1:]
+    if step == 1.0:
+        if 0 <= first and first + count <= len(source):
+            return source[first:first + count]
+        frames = pool.get("padded", (count,) + channels, source.dtype)
+        frames[:] = 0
+        rows = source[max(first, 0):first + count]
+        frames[max(-first, 0):max(-first, 0) + len(rows)] = rows
+        return frames
+
+    positions = pool.get("positions", (count,), np.float64)
+    np.add(pool.ramp(count), first, out=positions)
+    positions *= step
+    floor = pool.get("floor", (count,), np.float64)
+    np.floor(positions, out=floor)
+    base = pool.get("base", (count,), np.int64)
+    np.copyto(base, floor, casting="unsafe")
+    fraction = pool.get("fraction", (count, 1), np.float32)
+    np.subtract(positions, floor, out=fraction[:, 0], casting="unsafe")
+
+    taken = pool.get("taken", (count,) + channels, source.dtype)
+    left = gather_frames(source, base, pool.get("left", (count,) + channels), taken)
+    base += 1
+    right = gather_frames(source, base, pool.get("right", (count,) + channels), taken)
+    right -= left
+    right *= fraction
+    left += right
+    return left
+
+class Resampler:
+    """Changes the playback speed and frame rate of grains by linear interpolation.
+
+    Once the grains of a (sample, speed, direction) combination have
+    resampled about as much as resampling the whole source costs, it is
+    resampled once and kept in a byte-bounded cache, so later grains at that
+    speed are just a view of it. Until then, and for speeds that don't come
+    back, grains only resample their own region. Speeds are quantized the
+    way the frame rate override always did: to a whole source frame rate.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.cache = BufferCache(max_bytes)
+        self.seen = {}
+
+    def grain(self, sample, start_frame, end_frame, playback_speed, frame_rate):
+        """Return source frames start_frame..end_frame at frame_rate, played at
+        playback_speed (backwards if negative).
+
+        The result is a view of the sample, of cached resampled material or
+        of scratch memory, and is only valid until the next grain.
+        """
+        pool = get_scratch_pool()
+        source_rate = int(sample.frame_rate * abs(playback_speed))
+        if source_rate <= 0 or end_frame <= start_frame:
+            return pool.get("padded", (0, sample.channels), np.float32)
+        step = source_rate / frame_rate
+        source = sample.samples
+        reverse = playback_speed < 0
+        if reverse:
+            source = source[::-1]
+            start_frame, end_frame = len(source) - end_frame, len(source) - start_frame
+        if step == 1.0:
+            return resample_region(source, start_frame, end_frame, step, pool)
+
+        resampled_key = (sample.uid, source_rate, reverse, frame_rate)
+        resampled = self.cache.get(resampled_key) if resampled_key in self.seen else None
+        if resampled is None:
+            # Source frames resampled so far at this speed; resampling the whole
+            # source costs about as much as twice its length in grains
+            # Kept in a local, another thread can clear seen at any point
+            seen = self.seen.get(resampled_key, 0) + (end_frame - start_frame)
+            if len(self.seen) > 65536:
+                self.seen.clear()
+            self.seen[resampled_key] = seen
+            estimated_bytes = len(source) / step * sample.channels * 4
+            if seen < 2 * len(source) or estimated_bytes > self.cache.max_bytes / 4:
+                return resample_region(source, start_frame, end_frame, step, pool)
+            resampled = self.cache.put(resampled_key, resample_region(source, 0, len(source), step).copy())
+            # Should it get evicted, it has to pay off again before it's rebuilt
+            self.seen[resampled_key] = 0
+
+        # The resampled source is on the same grid, so the grain is a slice of it
+        return resample_region(resampled, start_frame / step, end_frame / step, 1.0, pool)
+
+
+# "linear" keeps the level of a centred grain at half of each side,
+# "constant_power" keeps its loudness the same across the stereo field
+pan_law = "linear"
+# Evaluate amplitude for every grain instead of once at the end of the piece
+per_grain_amplitude = False
+
+def pan_gains(pan_value):
+    """Return the (left, right) gains for a pan value between -1 and 1."""
+    pan_value = min(max(pan_value, -1), 1)
+    if pan_law == "constant_power":
+        angle = (pan_value + 1) * math.pi / 4
+        return math.cos(angle), math.sin(angle)
+    return (1 - pan_value) / 2, (1 + pan_value) / 2
+
+
+def fill_audio_based_on_formula(folder, duration_in_millis, all_folders):
+    """Render one folder on its own and return it as an AudioSegment."""
+    frame_rate, sample_width = get_mix_format([folder])
+    stem = render_folder_stem(folder, duration_in_millis, all_folders, frame_rate)
+    return stem.to_segment(sample_width)
+
+def render_folder_stem(folder, duration_in_millis, all_folders, frame_rate, score=None):
+    """Render one folder's grains, amplitude included, into its own MixBus."""
+    stem = MixBus(frame_count(duration_in_millis, frame_rate), frame_rate)
+    for onset_frame, grain, gains in iter_folder_grains(folder, duration_in_millis, all_folders, frame_rate, score):
+        stem.add_grain(grain, gains, onset_frame)
+    return stem
+
+def iter_folder_grains(folder, duration_in_millis, all_folders, frame_rate, score=None):
+    """Yield (onset_frame, grain, gains) for each of a folder's grains, in onset order.
+
+    See iter_schedule_grains.
+    """
+    plan = get_formula_plan(all_folders)
+    batches = get_folder_batches(plan, all_folders.index(folder), duration_in_millis, score)
+    return iter_schedule_grains(folder.audio_files, batches, frame_rate)
+
+def get_folder_batches(plan, folder_index, duration_in_millis, score=None):
+    """Return a folder's (onsets, values) grain batches, read from the score when there is one."""
+    if score is not None:
+        return score.batches(folder_index)
+    return iter_folder_batches(plan, folder_index, duration_in_millis)
+
+def iter_folder_batches(plan, folder_index, duration_in_millis, start_millis=0, end_millis=None):
+    """Yield a folder's (onsets, values) grain batches, with the amplitude every grain plays at.
+
+    Only grains starting from start_millis up to end_millis (by default the
+    end of the piece) are included.
+    """
+    amplitude = get_folder_amplitude(plan, folder_index, duration_in_millis)
+    # Every parameter is evaluated for a whole chunk of grain onsets at once
+    end_millis = duration_in_millis if end_millis is None else min(end_millis, duration_in_millis)
+    batches = iter_grain_batches(plan, folder_index, end_millis, start_millis=start_millis)
+    while True:
+        started = perf_counter() if render_stats.enabled else None
+        batch = next(batches, None)
+        if batch is None:
+            return
+        onsets, values = batch
+        if amplitude is not None:
+            values["amplitude"] = np.full(len(onsets), amplitude)
+        if started is not None:
+            render_stats.record("formulas", perf_counter() - started, sum(column.nbytes for column in values.values()))
+        yield onsets, values
+
+def get_folder_amplitude(plan, folder_index, duration_in_millis):
+    """Return the amplitude a whole folder plays at, or None when every grain has its own."""
+    if per_grain_amplitude:
+        return None
+    # The whole folder plays at the amplitude at the end of the piece
+    return plan.folder_values(folder_index, duration_in_millis)["amplitude"]
+
+# A grain score row. Onsets are in milliseconds like the schedules they come
+# from, so a score renders the same at whatever frame rate the mix has, and
+# sample is the index into the folder's samples
+grain_dtype = np.dtype([
+    ("onset", "<i8"),
+    ("sample", "<i4"),
+    ("start", "<f8"),
+    ("duration", "<f8"),
+    ("playback_speed", "<f8"),
+    ("panning", "<f8"),
+    ("fade_in", "<f8"),
+    ("fade_out", "<f8"),
+    ("amplitude", "<f8"),
+])
+
+class GrainScore:
+    """The evaluated grain schedules of a list of folders, a table per folder.
+
+    Each table is a structured array with a grain_dtype row per grain, in
+    onset order, so it can be inspected and analysed with plain NumPy.
+    Rendering from a score skips formula evaluation altogether. Scores are
+    saved as .npz files.
+    """
+
+    def __init__(self, tables, duration_in_millis):
+        self.tables = tables
+        self.duration_in_millis = duration_in_millis
+        self.keys = {}
+
+    @classmethod
+    def from_folders(cls, folders, duration_in_millis):
+        """Evaluate every folder's formulas into a score."""
+        plan = get_formula_plan(folders)
+        tables = []
+        for folder_index, folder in enumerate(folders):
+            onsets, values = concatenate_batches(iter_folder_batches(plan, folder_index, duration_in_millis))
+            if not folder.audio_files:
+                onsets = onsets[:0]  # No samples to pick from, the folder is silent
+            table = np.zeros(len(onsets), dtype=grain_dtype)
+            table["onset"] = onsets
+            if len(onsets):
+                # Resolved the way get_audio_for_time picks the sample
+                table["sample"] = np.asarray(values["sample"]).astype(np.int64) % len(folder.audio_files)
+                for formula_name in grain_dtype.names[2:]:
+                    table[formula_name] = values[formula_name]
+            tables.append(table)
+        return cls(tables, duration_in_millis)
+
+    def batches(self, folder_index, batch_size=65536):
+        """Yield the folder's grains as (onsets, values) batches for iter_schedule_grains."""
+        table = self.tables[folder_index]
+        for first in range(0, len(table), batch_size):
+            rows = table[first:first + batch_size]
+            yield rows["onset"], {formula_name: rows[formula_name] for formula_name in grain_dtype.names[1:]}
+
+    def key(self, folder_index):
+        """A digest of the folder's table, for the stem cache."""
+        digest = self.keys.get(folder_index)
+        if digest is None:
+            digest = hashlib.sha1(self.tables[folder_index].tobytes()).hexdigest()
+            self.keys[folder_index] = digest
+        return digest
+
+    def describe(self):
+        """Return count, min, max, mean and std of every column, per folder."""
+        folders = []
+        for table in self.tables:
+            columns = {}
+            for name in grain_dtype.names:
+                column = table[name]
+                columns[name] = {
+                    "min": column.min().item() if len(column) else None,
+                    "max": column.max().item() if len(column) else None,
+                    "mean": column.mean().item() if len(column) else None,
+                    "std": column.std().item() if len(column) else None,
+                }
+            folders.append({"grains": len(table), "columns": columns})
+        return {"duration_in_millis": self.duration_in_millis, "folders": folders}
+
+    def save(self, path):
+        arrays = {f"folder_{index}": table for index, table in enumerate(self.tables)}
+        with open(path, "wb") as score_file:
+            np.savez(score_file, duration_in_millis=np.int64(self.duration_in_millis), **arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            count = sum(1 for name in arrays.files if name.startswith("folder_"))
+            tables = [arrays[f"folder_{index}"] for index in range(count)]
+            duration_in_millis = int(arrays["duration_in_millis"])
+        for table in tables:
+            if table.dtype != grain_dtype:
+                raise ValueError(f"{path} isn't a grain score of this version")
+        return cls(tables, duration_in_millis)
+
+def iter_schedule_grains(audios, batches, frame_rate):
+    """Render the grains of already evaluated (onsets, values) batches, in onset order.
+
+    Yields (onset_frame, grain, gains): grain is the resampled (frames,
+    channels) float32 source material at frame_rate, gains the (frames, 2)
+    window x pan x amplitude curve. grain * gains is the finished stereo
+    grain, a mono grain is upmixed by the broadcast; see add_grain. Grains
+    that come from grain_cache are already finished and have gains None.
+    Without audios there's nothing to play and nothing is yielded.
+    """
+    if not audios:
+        return
+    for onsets, values in batches:
+        columns = {formula_name: column.tolist() for formula_name, column in values.items()}
+        for i, t_millis in enumerate(onsets.tolist()):
+            # Checked per grain, so stats can be switched on during a render
+            timing = render_stats.enabled
+            if timing:
+                started = perf_counter()
+            sample = get_audio_for_time(audios, columns["sample"][i])
+            playback_speed = columns["playback_speed"][i]
+            onset_frame = frame_count(t_millis, frame_rate)
+            grain_start, grain_end = grain_frames(sample, columns["start"][i], columns["duration"][i])
+
+            # Played backwards, the fade-in ends up at the end
+            fade_in_percent, fade_out_percent = columns["fade_in"][i], columns["fade_out"][i]
+            if playback_speed < 0:
+                fade_in_percent, fade_out_percent = fade_out_percent, fade_in_percent
+
+            # Fold the pan law, amplitude and sample scale into the window
+            left_gain, right_gain = pan_gains(columns["panning"][i])
+            scale = columns["amplitude"][i] / full_scale(sample.sample_width)
+            left_gain, right_gain = left_gain * scale, right_gain * scale
+
+            # Everything the finished grain is made of
+            grain_key = (sample.uid, grain_start, grain_end, playback_speed, frame_rate, fade_in_percent, fade_out_percent, left_gain, right_gain)
+            finished = grain_cache.get(grain_key)
+            if finished is not None:
+                if timing:
+                    render_stats.record("cached_grains", perf_counter() - started, finished.nbytes)
+                yield onset_frame, finished, None
+                continue
+
+            # Cut the grain, resampled to the mix frame rate at its playback speed
+            grain = resampler.grain(sample, grain_start, grain_end, playback_speed, frame_rate)[:, :2]
+            if timing:
+                resampled = perf_counter()
+                render_stats.record("resample", resampled - started, grain.nbytes)
+
+            gains = grain_gains(len(grain), fade_in_percent, fade_out_percent, left_gain, right_gain)
+            if timing:
+                render_stats.record("gains", perf_counter() - resampled, gains.nbytes)
+
+            if grain_cache.admit(grain_key):
+                yield onset_frame, grain_cache.put(grain_key, grain * gains), None
+            else:
+                yield onset_frame, grain, gains
+
+def grain_gains(num_frames, fade_in_percent, fade_out_percent, left_gain, right_gain):
+    """Return the (frames, 2) float32 curve a grain is multiplied by: the Hann window per channel gain.
+
+    The curve lives in scratch memory and is only valid until the next grain.
+    """
+    fade_in_frames = int((fade_in_percent / 100) * num_frames)
+    fade_out_frames = int((fade_out_percent / 100) * num_frames)
+    window = get_hann_window(num_frames, fade_in_frames, fade_out_frames)
+    gains = get_scratch_pool().get("gains", (num_frames, 2))
+    np.multiply(window, left_gain, out=gains[:, 0], casting="unsafe")
+    np.multiply(window, right_gain, out=gains[:, 1], casting="unsafe")
+    return gains
+
+def add_grain(target, grain, gains, offset_frame):
+    """Sum a grain into a (frames, channels) buffer at offset_frame in one multiply-add.
+
+    With gains None the grain is already finished and is only added.
+    Returns the part of the grain that ran past the end of the buffer.
+    """
+    started = perf_counter() if render_stats.enabled else None
+    count = max(min(len(grain), len(target) - offset_frame), 0)
+    if gains is None:
+        target[offset_frame:offset_frame + count] += grain[:count]
+        if started is not None:
+            render_stats.record("mix", perf_counter() - started, grain[:count].nbytes)
+        return grain[count:], None
+    mixed = get_scratch_pool().get("mixed", (count,) + target.shape[1:])
+    np.multiply(grain[:count], gains[:count], out=mixed)
+    target[offset_frame:offset_frame + count] += mixed
+    if started is not None:
+        render_stats.record("mix", perf_counter() - started, mixed.nbytes)
+    return grain[count:], gains[count:]
+
+def render_mix(folders, duration_in_millis, all_folders, keep_stems=False, workers=None, score=None):
+    """Render every folder and sum the stems into one MixBus.
+
+    Returns (mix, stems) where stems maps each folder to its MixBus when
+    keep_stems is set, and is empty otherwise. Folders are rendered in up to
+    `workers` processes (render_workers by default); the result is the same
+    as rendering them one after another. Stems in the stem cache aren't
+    rendered again, see get_stem_key.
+    """
+    frame_rate, sample_width = get_mix_format(folders)
+    num_frames = frame_count(duration_in_millis, frame_rate)
+    mix = MixBus(num_frames, frame_rate)
+    folders = sounding_folders(folders)
+    stems = {}
+
+    plan = get_formula_plan(all_folders)
+    stem_keys = [get_stem_key(plan, all_folders.index(folder), duration_in_millis, frame_rate, score) for folder in folders]
+    # A folder that's still loading gets new sample lists, see FolderLoader
+    keyed_samples = [folder.audio_files for folder in folders]
+    cached_stems = [stem_cache.get(stem_key) for stem_key in stem_keys]
+    mixed_count = 0
+
+    def add_stem(folder, stem_buffer):
+        mix.add(stem_buffer, 0)
+        if keep_stems:
+            stems[folder] = MixBus(num_frames, frame_rate, buffer=np.array(stem_buffer))
+
+    def add_cached_stems(stop):
+        # Stems are summed in folder order whichever way they came, so the mix doesn't depend on the cache
+        nonlocal mixed_count
+        for index in range(mixed_count, stop):
+            if cached_stems[index] is not None:
+                add_stem(folders[index], cached_stems[index])
+        mixed_count = stop
+
+    def add_rendered_stem(folder, stem_buffer):
+        nonlocal mixed_count
+        index = folders.index(folder)
+        add_cached_stems(index)
+        add_stem(folder, stem_buffer)
+        mixed_count = index + 1
+        if stem_buffer.nbytes <= stem_cache.max_bytes and folder.audio_files is keyed_samples[index]:
+            stem_cache.put(stem_keys[index], np.array(stem_buffer))
+
+    missing = [folder for folder, cached in zip(folders, cached_stems) if cached is None]
+    if workers is None:
+        workers = render_workers or os.cpu_count() or 1
+    if workers > 1 and missing:
+        # Even a single folder, it's split into time shards
+        render_stems_in_parallel(missing, duration_in_millis, all_folders, frame_rate, workers, add_rendered_stem, score)
+    else:
+        for folder in missing:
+            add_rendered_stem(folder, render_folder_stem(folder, duration_in_millis, all_folders, frame_rate, score).buffer)
+    add_cached_stems(len(folders))
+    return mix, stems
+
+def get_stem_key(plan, folder_index, duration_in_millis, frame_rate, score=None):
+    """Return what a folder's stem depends on, as a stem_cache key.
+
+    That's the folder's formulas plus those of every folder they reference,
+    directly or through other folders, its samples, the duration and the
+    mix format, and the global pan and amplitude settings. Rendered from a
+    score, the folder's table takes the place of the formulas.
+    """
+    folder = plan.folders[folder_index]
+    samples = tuple(sample.uid for sample in folder.audio_files)
+    if score is not None:
+        return "score", score.key(folder_index), samples, duration_in_millis, frame_rate, pan_law
+    formulas = tuple(plan.closure_steps([key for _, key in plan.folder_keys[folder_index]]))
+    return formulas, samples, duration_in_millis, frame_rate, pan_law, per_grain_amplitude
+
+# Number of processes folders are rendered in, None for one per CPU core
+render_workers = None
+# Grains per time shard below which a folder isn't split any further
+min_grains_per_shard = 256
+render_pools = {}
+
+def get_render_pool(workers):
+    pool = render_pools.get(workers)
+    if pool is None:
+        # Spawn rather than fork, the GUI and playback threads don't survive a fork
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        render_pools[workers] = pool
+    return pool
+
+def render_stems_in_parallel(folders, duration_in_millis, all_folders, frame_rate, workers, on_stem, score=None):
+    """Render each folder's stem in worker processes.
+
+    Grain schedules, including the folder_N_param values they reference, are
+    evaluated here up front, so workers only render audio. A dense folder is
+    split into time shards with about the same number of grains each, which
+    render on separate workers straight into their range of the stem. A
+    shard also renders the earlier grains that reach into its range,
+    clipped to it, so every frame sums the same grains in the same order as
+    the serial render and the stems are bit-identical. Sample data and the
+    rendered stems go through shared memory instead of being pickled.
+    on_stem(folder, buffer) is called for every stem in folder order; the
+    buffer is only valid during the call.
+    """
+    shared = []
+    try:
+        jobs = submit_stems(get_render_pool(workers), folders, duration_in_millis, all_folders, frame_rate, workers, shared, score)
+        collect_stems(jobs, on_stem)
+    finally:
+        release_shared(shared)
+
+def submit_stems(pool, folders, duration_in_millis, all_folders, frame_rate, workers, shared, score=None):
+    """Evaluate the folders' schedules and queue their shards on the pool, see render_stems_in_parallel.
+
+    Returns the jobs for collect_stems. The shared memory blocks are added
+    to shared, for release_shared once the jobs are collected.
+    """
+    plan = get_formula_plan(all_folders)
+    num_frames = frame_count(duration_in_millis, frame_rate)
+    # Enough shards to keep every worker busy even when there's only one folder
+    shards_per_folder = -(-workers // len(folders))
+    jobs = []
+    for folder in folders:
+        onsets, values = concatenate_batches(get_folder_batches(plan, all_folders.index(folder), duration_in_millis, score))
+        samples, sample_descriptions = share_samples(folder.audio_files)
+        shared.append(samples)
+        stem = shared_memory.SharedMemory(create=True, size=max(num_frames * 2 * 4, 1))
+        shared.append(stem)
+        reach = grain_reach(folder.audio_files, onsets, values, frame_rate) if len(onsets) else onsets
+        futures = []
+        for first, last, start_frame, end_frame in split_schedule(onsets, frame_rate, num_frames, shards_per_folder):
+            # Earlier grains still sounding at the start of the shard, then its own
+            grains = np.concatenate([np.flatnonzero(reach[:first] > start_frame), np.arange(first, last)])
+            batches = [(onsets[grains], {formula_name: column[grains] for formula_name, column in values.items()})]
+            futures.append(pool.submit(render_shard_task, samples.name, sample_descriptions, stem.name, num_frames, start_frame, end_frame, frame_rate, batches, render_stats.enabled, pan_law))
+        jobs.append((folder, futures, stem, num_frames))
+    return jobs
+
+def collect_stems(jobs, on_stem):
+    """Wait for the jobs of submit_stems and call on_stem(folder, buffer) for each, in order."""
+    for folder, futures, stem, num_frames in jobs:
+        for future in futures:
+            shard_stats = future.result()
+            if shard_stats is not None:
+                render_stats.merge(shard_stats)
+        stem_buffer = np.ndarray((num_frames, 2), dtype=np.float32, buffer=stem.buf)
+        on_stem(folder, stem_buffer)
+        del stem_buffer
+
+def release_shared(shared):
+    for block in shared:
+        block.close()
+        block.unlink()
+
+def concatenate_batches(batches):
+    """Join (onsets, values) batches into a single schedule."""
+    batches = list(batches)
+    if not batches:
+        return np.zeros(0, dtype=np.int64), {}
+    onsets = np.concatenate([batch_onsets for batch_onsets, _ in batches])
+    values = {formula_name: np.concatenate([batch_values[formula_name] for _, batch_values in batches]) for formula_name in batches[0][1]}
+    return onsets, values
+
+def split_schedule(onsets, frame_rate, num_frames, shards):
+    """Split a schedule into up to `shards` time ranges with about as many grains each.
+
+    Returns (first_grain, last_grain, start_frame, end_frame) per shard. Shard
+    boundaries fall on grain onsets and the shards cover the whole timeline.
+    """
+    shards = max(1, min(shards, len(onsets) // min_grains_per_shard))
+    cuts = sorted({len(onsets) * i // shards for i in range(1, shards)})
+    onset_frames = [frame_count(t_millis, frame_rate) for t_millis in onsets[cuts].tolist()]
+    firsts = [0] + cuts
+    lasts = cuts + [len(onsets)]
+    start_frames = [0] + onset_frames
+    end_frames = onset_frames + [num_frames]
+    return list(zip(firsts, lasts, start_frames, end_frames))
+
+def grain_reach(audios, onsets, values, frame_rate):
+    """Return a frame each grain of a schedule has surely ended by, at frame_rate.
+
+    An upper bound of the grain lengths iter_schedule_grains renders, from
+    the sample lengths, durations and playback speeds; a grain that ends
+    sooner only costs a shard a grain that adds nothing to it.
+    """
+    lengths = np.array([len(sample) for sample in audios], dtype=np.float64)
+    rates = np.array([sample.frame_rate for sample in audios], dtype=np.float64)
+    picked = np.asarray(values["sample"]).astype(np.int64) % len(audios)
+    length, rate = lengths[picked], rates[picked]
+    duration = np.clip(np.asarray(values["duration"], dtype=np.float64), 0, 100)
+    source_frames = np.minimum(duration / 100 * length + 1, length) * rate / 1000 + 1
+    source_rate = np.maximum(np.floor(rate * np.abs(np.asarray(values["playback_speed"], dtype=np.float64))), 1)
+    onset_frames = np.floor(np.asarray(onsets, dtype=np.float64) * frame_rate / 1000)
+    return (onset_frames + source_frames * frame_rate / source_rate).astype(np.int64) + 2
+
+def share_samples(samples):
+    """Describe samples so worker processes can open them without pickling their data.
+
+    Samples mapped from the sample library are described by their cache
+    file, which workers map themselves. The others are copied into one
+    shared memory block. Returns the block and a description per sample.
+    """
+    descriptions = []
+    offset = 0
+    for sample in samples:
+        if sample.cache_path is not None and isinstance(sample.samples, np.memmap):
+            descriptions.append(("mapped", sample.cache_path, sample.frame_rate))
+        else:
+            descriptions.append(("shared", offset, sample.samples.shape, sample.samples.dtype.str, sample.frame_rate))
+            offset += sample.samples.nbytes
+    block = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+    for sample, description in zip(samples, descriptions):
+        if description[0] == "shared":
+            _, offset, shape, dtype, _ = description
+            np.ndarray(shape, dtype=dtype, buffer=block.buf, offset=offset)[:] = sample.samples
+    return block, descriptions
+
+def open_shared_samples(memory, descriptions):
+    samples = []
+    for description in descriptions:
+        if description[0] == "mapped":
+            _, cache_path, frame_rate = description
+            samples.append(Sample(open_cached_samples(cache_path), frame_rate, cache_path=cache_path))
+        else:
+            _, offset, shape, dtype, frame_rate = description
+            frames = np.ndarray(shape, dtype=dtype, buffer=memory, offset=offset)
+            frames.setflags(write=False)
+            samples.append(Sample(frames, frame_rate))
+    return samples
+
+def render_shard_task(samples_name, sample_descriptions, stem_name, num_frames, start_frame, end_frame, frame_rate, batches, stats_enabled=False, render_pan_law="linear"):
+    """Worker side of render_stems_in_parallel.
+
+    Settings the grains depend on are passed along, spawned workers only
+    have the module defaults. Returns the shard's stage timings when
+    stats_enabled is set (None otherwise).
+    """
+    global pan_law
+    samples = shared_memory.SharedMemory(name=samples_name)
+    stem = shared_memory.SharedMemory(name=stem_name)
+    render_stats.enabled = stats_enabled
+    pan_law = render_pan_law
+    render_stats.reset()
+    try:
+        render_shard_into(stem.buf, samples.buf, sample_descriptions, batches, num_frames, start_frame, end_frame, frame_rate)
+        return render_stats.samples() if stats_enabled else None
+    finally:
+        samples.close()
+        stem.close()
+
+def render_shard_into(memory, sample_memory, sample_descriptions, batches, num_frames, start_frame, end_frame, frame_rate):
+    audios = open_shared_samples(sample_memory, sample_descriptions)
+    shard = np.ndarray((num_frames, 2), dtype=np.float32, buffer=memory)[start_frame:end_frame]
+    shard[:] = 0
+    for onset_frame, grain, gains in iter_schedule_grains(audios, batches, frame_rate):
+        offset = onset_frame - start_frame
+        if offset < 0:
+            # A grain from before the shard, only its part in the shard is summed here
+            grain = grain[-offset:]
+            gains = gains[-offset:] if gains is not None else None
+            offset = 0
+        add_grain(shard, grain, gains, offset)
+
+def render_blocks(folders, duration_in_millis, all_folders, block_frames=8192, score=None, collect=True):
+    """Render the mix block by block, yielding (frames, 2) float32 arrays.
+
+    Grains that run past the end of a block are carried over into the next
+    one, so memory stays bounded by the block size plus the longest grain.
+    Rendering only happens as blocks are pulled, so closing the generator
+    stops the render. The blocks add up to exactly what render_mix produces.
+
+    Stems in the stem cache are played from there. The others are also
+    collected, if they fit in the cache and collect is set, and cached once
+    the last block is out, so exporting what was just played doesn't render
+    it again.
+    """
+    frame_rate, _ = get_mix_format(folders)
+    total_frames = frame_count(duration_in_millis, frame_rate)
+    plan = get_formula_plan(all_folders)
+    stems = []
+    folders = sounding_folders(folders)
+    # All collected stems together stay within what the cache holds
+    collect_budget = stem_cache.max_bytes if collect else 0
+    for folder in folders:
+        stem_key = get_stem_key(plan, all_folders.index(folder), duration_in_millis, frame_rate, score)
+        cached = stem_cache.get(stem_key)
+        if cached is not None:
+            stems.append([None, None, None, cached, None])
+            continue
+        grains = iter_folder_grains(folder, duration_in_millis, all_folders, frame_rate, score)
+        collected = None
+        if total_frames * 2 * 4 <= collect_budget:
+            collected = np.zeros((total_frames, 2), dtype=np.float32)
+            collect_budget -= collected.nbytes
+        stems.append([grains, hold_grain(next(grains, None)), CarryBuffer(block_frames), collected, stem_key])
+
+    for block_start in range(0, total_frames, block_frames):
+        block_end = block_start + block_frames
+        block = np.zeros((block_frames, 2), dtype=np.float32)
+        for stem in stems:
+            grains, pending, carry, stem_buffer, _ = stem
+            if grains is None:
+                rows = stem_buffer[block_start:block_end]
+                mix_into(block[:len(rows)], rows)
+                continue
+            while pending is not None and pending[0] < block_end:
+                carry.add(*pending)
+                pending = next(grains, None)
+            stem[1] = hold_grain(pending)
+            stem_block = carry.pop_block()
+            if stem_buffer is not None:
+                stem_buffer[block_start:block_end] = stem_block[:total_frames - block_start]
+            mix_into(block, stem_block)
+        yield block[:total_frames - block_start]
+
+    for grains, _, _, stem_buffer, stem_key in stems:
+        if grains is not None and stem_buffer is not None:
+            stem_cache.put(stem_key, stem_buffer)
+
+def hold_grain(grain):
+    """Copy a grain out of scratch memory so it survives other folders' grains."""
+    if grain is None:
+        return None
+    onset_frame, samples, gains = grain
+    if gains is None:
+        return grain  # From grain_cache, which never changes a grain it holds
+    return onset_frame, samples.copy(), gains.copy()
+
+class CarryBuffer:
+    """Accumulator for one block of a stream plus the grain tails running past it."""
+
+    def __init__(self, block_frames, channels=2):
+        self.block_frames = block_frames
+        self.start_frame = 0
+        self.buffer = np.zeros((block_frames, channels), dtype=np.float32)
+
+    def add(self, onset_frame, grain, gains):
+        start = onset_frame - self.start_frame
+        end = start + len(grain)
+        if end > len(self.buffer):
+            grown = np.zeros((end, self.buffer.shape[1]), dtype=np.float32)
+            grown[:len(self.buffer)] = self.buffer
+            self.buffer = grown
+        add_grain(self.buffer, grain, gains, start)
+
+    def pop_block(self):
+        """Return the current block and move on to the next one."""
+        block = self.buffer[:self.block_frames].copy()
+        self.buffer[:-self.block_frames] = self.buffer[self.block_frames:]
+        self.buffer[-self.block_frames:] = 0
+        self.start_frame += self.block_frames
+        return block
+
+class RingBuffer:
+    """Single producer, single consumer ring of (frames, channels) float32 audio.
+
+    The writer only advances write_count and the reader only read_count,
+    each after copying its frames, so the two threads never take a lock.
+    """
+
+    def __init__(self, capacity, channels=2):
+        self.capacity = capacity
+        self.buffer = np.zeros((capacity, channels), dtype=np.float32)
+        self.write_count = 0
+        self.read_count = 0
+
+    def available(self):
+        return self.write_count - self.read_count
+
+    def space(self):
+        return self.capacity - self.available()
+
+    def write(self, frames):
+        """Append frames, which have to fit in space()."""
+        start = self.write_count % self.capacity
+        first = min(len(frames), self.capacity - start)
+        self.buffer[start:start + first] = frames[:first]
+        self.buffer[:len(frames) - first] = frames[first:]
+        self.write_count += len(frames)
+
+    def read_into(self, out):
+        """Fill out with as many frames as there are, returns how many."""
+        count = min(len(out), self.available())
+        start = self.read_count % self.capacity
+        first = min(count, self.capacity - start)
+        out[:first] = self.buffer[start:start + first]
+        out[first:count] = self.buffer[:count - first]
+        self.read_count += count
+        return count
+
+class LivePlayer:
+    """Plays folders live through a PyAudio callback stream.
+
+    A scheduler thread renders block_frames at a time, at most about
+    lookahead_millis ahead of the playhead, into a RingBuffer the audio
+    callback reads from. Every block is scheduled with the current formula
+    plan, so edits made through update_formula are heard within the
+    lookahead. While a formula doesn't compile or evaluate (halfway through
+    typing it, say) the last plan that did keeps playing. Callbacks that
+    find the ring short are counted in underruns.
+
+    If playback runs to the end without edits, the stems it rendered go into
+    the stem cache, like render_blocks, so exporting right after is a re-mix.
+    """
+
+    def __init__(self, folders, all_folders, duration_in_millis, block_frames=512, lookahead_millis=40, on_finish=None):
+        self.folders = folders
+        self.all_folders = all_folders
+        self.duration_in_millis = duration_in_millis
+        self.frame_rate, self.sample_width = get_mix_format(folders)
+        self.total_frames = frame_count(duration_in_millis, self.frame_rate)
+        self.block_frames = block_frames
+        self.ring = RingBuffer(max(2 * block_frames, frame_count(lookahead_millis, self.frame_rate)))
+        self.on_finish = on_finish
+        self.block_start = 0
+        self.voices = {}
+        self.collect_budget = stem_cache.max_bytes
+        self.plan = None
+        self.first_plan = None
+        self.played_frames = 0
+        self.underruns = 0
+        self.errors = 0
+        self.last_error = None
+        self.blocks_rendered = 0
+        self.render_seconds = 0.0
+        self.max_block_seconds = 0.0
+        self.stopping = threading.Event()
+        self.close_lock = threading.Lock()
+        self.stream = None
+        self.audio = None
+        self.scheduler = None
+
+    def current_plan(self):
+        try:
+            self.plan = get_formula_plan(self.all_folders)
+        except Exception as error:
+            self.note_error(error)
+        if self.first_plan is None:
+            self.first_plan = self.plan
+        return self.plan
+
+    def note_error(self, error):
+        self.errors += 1
+        self.last_error = f"{type(error).__name__}: {error}"
+
+    def get_voice(self, folder):
+        """Return [next onset, CarryBuffer, collected stem or None, samples] for a folder."""
+        voice = self.voices.get(folder)
+        if voice is None:
+            carry = CarryBuffer(self.block_frames)
+            # Folders added while playing start at the playhead
+            carry.start_frame = self.block_start
+            next_onset = -(-self.block_start * 1000 // self.frame_rate)
+            while frame_count(next_onset, self.frame_rate) < self.block_start:
+                next_onset += 1
+            collected = None
+            if self.block_start == 0 and self.total_frames * 2 * 4 <= self.collect_budget:
+                collected = np.zeros((self.total_frames, 2), dtype=np.float32)
+                self.collect_budget -= collected.nbytes
+            voice = self.voices[folder] = [next_onset, carry, collected, folder.audio_files]
+        return voice
+
+    def schedule(self, plan, folder, voice, block_end):
+        """Add the grains of a folder that start before block_end to its carry buffer."""
+        folder_index = plan.folders.index(folder)
+        end_millis = min(-(-block_end * 1000 // self.frame_rate), self.duration_in_millis)
+        while end_millis > 0 and frame_count(end_millis - 1, self.frame_rate) >= block_end:
+            end_millis -= 1
+        onsets, voice[0] = follow_spacing(plan, context_key(folder_index, "spacing"), voice[0], end_millis)
+        if not onsets:
+            return
+        onsets = np.asarray(onsets, dtype=np.int64)
+        values = plan.folder_values_batch(folder_index, onsets)
+        amplitude = get_folder_amplitude(plan, folder_index, self.duration_in_millis)
+        if amplitude is not None:
+            values["amplitude"] = np.full(len(onsets), amplitude)
+        if folder.audio_files is not voice[3]:
+            voice[2] = None  # Samples came in while playing, the stem doesn't match either list
+        for onset_frame, grain, gains in iter_schedule_grains(folder.audio_files, [(onsets, values)], self.frame_rate):
+            voice[1].add(onset_frame, grain, gains)
+
+    def render_block(self):
+        """Render the next block into the ring buffer."""
+        started = perf_counter()
+        plan = self.current_plan()
+        block_end = self.block_start + self.block_frames
+        block = np.zeros((self.block_frames, 2), dtype=np.float32)
+        rows = min(self.block_frames, self.total_frames - self.block_start)
+        for folder in list(self.folders):
+            voice = self.get_voice(folder)
+            if plan is not None and folder in plan.folders:
+                try:
+                    self.schedule(plan, folder, voice, block_end)
+                except Exception as error:
+                    # Those grains are skipped, the next block tries again
+                    self.note_error(error)
+            stem_block = voice[1].pop_block()
+            if voice[2] is not None:
+                voice[2][self.block_start:self.block_start + rows] = stem_block[:rows]
+            mix_into(block, stem_block)
+        self.ring.write(block[:rows])
+        self.block_start += rows
+
+        seconds = perf_counter() - started
+        self.blocks_rendered += 1
+        self.render_seconds += seconds
+        self.max_block_seconds = max(self.max_block_seconds, seconds)
+
+    def callback(self, in_data, frame_count, time_info, status):
+        out = np.zeros((frame_count, 2), dtype=np.float32)
+        count = self.ring.read_into(out)
+        self.played_frames += count
+        finished = self.block_start >= self.total_frames and not self.ring.available()
+        if status or (count < frame_count and not finished):
+            self.underruns += 1
+        flag = self.pyaudio.paComplete if finished or self.stopping.is_set() else self.pyaudio.paContinue
+        return float_to_pcm(out, self.sample_width).tobytes(), flag
+
+    def start(self):
+        # Only loaded once something is played, rendering doesn't need an audio device
+        import pyaudio
+        self.pyaudio = pyaudio
+
+        # Fill the lookahead first, so playback doesn't start with an underrun
+        while self.ring.space() >= self.block_frames and self.block_start < self.total_frames:
+            self.render_block()
+        self.audio = pyaudio.PyAudio()
+        self.stream = self.audio.open(format=self.audio.get_format_from_width(self.sample_width),
+                                      channels=2,
+                                      rate=self.frame_rate,
+                                      output=True,
+                                      frames_per_buffer=self.block_frames // 2,
+                                      stream_callback=self.callback)
+        self.scheduler = threading.Thread(target=self.run_scheduler, daemon=True)
+        self.scheduler.start()
+
+    def run_scheduler(self):
+        block_seconds = self.block_frames / self.frame_rate
+        while not self.stopping.is_set() and self.block_start < self.total_frames:
+            if self.ring.space() >= self.block_frames:
+                self.render_block()
+            else:
+                self.stopping.wait(block_seconds / 4)
+        # Let the callback play what's left
+        while not self.stopping.is_set() and self.ring.available():
+            self.stopping.wait(block_seconds)
+        if self.block_start >= self.total_frames and not self.stopping.is_set():
+            self.cache_stems()
+        self.close()
+
+    def cache_stems(self):
+        if self.plan is not self.first_plan or self.errors:
+            return  # Edited while playing, the stems don't match any formulas now
+        for folder, (_, _, collected, _) in self.voices.items():
+            if collected is not None and folder in self.plan.folders:
+                stem_key = get_stem_key(self.plan, self.plan.folders.index(folder), self.duration_in_millis, self.frame_rate)
+                stem_cache.put(stem_key, collected)
+
+    def stop(self):
+        self.stopping.set()
+        if self.scheduler is not None and self.scheduler is not threading.current_thread():
+            self.scheduler.join()
+        self.close()
+
+    def close(self):
+        with self.close_lock:
+            if self.stream is None:
+                return
+            self.stream.stop_stream()
+            self.stream.close()
+            self.audio.terminate()
+            self.stream = None
+        if self.on_finish is not None:
+            self.on_finish(self)
+
+    def latency_millis(self):
+        """Worst case time from rendering a frame to handing it to the device."""
+        return 1000 * (self.ring.capacity + self.block_frames // 2) / self.frame_rate
+
+    def report(self):
+        return {
+            "played_seconds": self.played_frames / self.frame_rate,
+            "underruns": self.underruns,
+            "errors": self.errors,
+            "last_error": self.last_error,
+            "latency_millis": self.latency_millis(),
+            "blocks": self.blocks_rendered,
+            "mean_block_seconds": self.render_seconds / self.blocks_rendered if self.blocks_rendered else 0.0,
+            "max_block_seconds": self.max_block_seconds,
+            "block_seconds": self.block_frames / self.frame_rate,
+        }
 
+# Drafts render at this fraction of the mix frame rate
+draft_rate_divisor = 4
+
+# Frames drafts render in one go, which bounds their scratch memory
+draft_chunk_frames = 1 << 20
+
+def pan_gains_batch(pan_values):
+    """pan_gains over an array of pan values."""
+    pan_values = np.clip(pan_values, -1, 1)
+    if pan_law == "constant_power":
+        angles = (pan_values + 1) * math.pi / 4
+        return np.cos(angles), np.sin(angles)
+    return (1 - pan_values) / 2, (1 + pan_values) / 2
+
+def add_draft_grains(target, audios, onsets, values, frame_rate, first_frame):
+    """Sum a batch of grains into a draft, see render_draft.
+
+    Grains of a sample that have the same shape (length, speed and fades),
+    which with constant or periodic formulas is most of them, are rendered
+    together. Speeds are rounded to 1/64 and lengths to about 4% for that.
+    Each shape takes one gather of nearest neighbour source frames and one
+    Hann window for all of its grains, which are then summed into target. A mono draft
+    pans by giving each grain the mean of its left and right gain.
+    """
+    channels = target.shape[1]
+    columns = {formula_name: np.asarray(column, dtype=np.float64) for formula_name, column in values.items()}
+    sample_indices = columns["sample"].astype(np.int64) % len(audios)
+    left_gains, right_gains = pan_gains_batch(columns["panning"])
+    onset_frames = (onsets * frame_rate // 1000).astype(np.int64) - first_frame
+    for sample_index in np.unique(sample_indices).tolist():
+        sample = audios[sample_index]
+        grains = np.flatnonzero(sample_indices == sample_index)
+        speeds = columns["playback_speed"][grains]
+
+        # grain_frames, on arrays
+        length_millis = len(sample)
+        start_millis = np.trunc(columns["start"][grains] / 100 * length_millis)
+        end_millis = np.minimum(start_millis + np.trunc(columns["duration"][grains] / 100 * length_millis), length_millis)
+        start_millis = np.where(start_millis < 0, length_millis + start_millis, np.minimum(start_millis, length_millis))
+        start_frames = (start_millis * sample.frame_rate / 1000).astype(np.int64)
+        end_frames = (np.maximum(end_millis, 0) * sample.frame_rate / 1000).astype(np.int64)
+
+        # Speeds and lengths are rounded a little, so grains that vary continuously still share shapes
+        steps = np.round(sample.frame_rate * np.abs(speeds) / frame_rate * 64) / 64
+        counts = np.maximum(end_frames - start_frames, 0) / np.where(steps > 0, steps, np.inf)
+        counts = np.where(counts >= 1, np.exp2(np.round(np.log2(np.maximum(counts, 1)) * 16) / 16), 0).astype(np.int64)
+        reverse = speeds < 0
+        fade_in = np.where(reverse, columns["fade_out"][grains], columns["fade_in"][grains])
+        fade_out = np.where(reverse, columns["fade_in"][grains], columns["fade_out"][grains])
+        fade_in_frames = (fade_in / 100 * counts).astype(np.int64)
+        fade_out_frames = (fade_out / 100 * counts).astype(np.int64)
+        scale = columns["amplitude"][grains] / full_scale(sample.sample_width)
+        if channels == 1:
+            grain_gains = [(left_gains[grains] + right_gains[grains]) / 2 * scale]
+        else:
+            grain_gains = [left_gains[grains] * scale, right_gains[grains] * scale]
+
+        shapes = np.stack([counts, steps, reverse, fade_in_frames, fade_out_frames], axis=1)
+        shapes, shape_of_grain = np.unique(shapes, axis=0, return_inverse=True)
+        for shape_index, (count, step, backwards, fade_in_count, fade_out_count) in enumerate(shapes.tolist()):
+            count = int(count)
+            if count <= 0:
+                continue
+            positions = np.floor(np.arange(count) * step).astype(np.int64)
+            window = get_hann_window(count, int(fade_in_count), int(fade_out_count))
+            members = np.flatnonzero(shape_of_grain.ravel() == shape_index)
+            # Rows of grains, in chunks that keep the gathered frames bounded
+            rows_per_chunk = max(draft_chunk_frames // count, 1)
+            for chunk_start in range(0, len(members), rows_per_chunk):
+                chunk = members[chunk_start:chunk_start + rows_per_chunk]
+                if backwards:
+                    source_frames = (end_frames[chunk] - 1)[:, None] - positions
+                else:
+                    source_frames = start_frames[chunk][:, None] + positions
+                gathered = np.take(sample.samples, source_frames, axis=0, mode="clip")
+                offsets = onset_frames[grains[chunk]].tolist()
+                for channel in range(channels):
+                    weights = gathered[:, :, min(channel, sample.channels - 1)] * window.astype(np.float32)
+                    weights *= grain_gains[channel][chunk][:, None].astype(np.float32)
+                    column = target[:, channel]
+                    for offset, row in zip(offsets, weights):
+                        # Onsets are in the draft's range, only the end of the last grains can run past it
+                        column[offset:offset + count] += row[:len(target) - offset]
+
+def render_draft(folders, duration_in_millis, all_folders, start_millis=0, end_millis=None, mono=True, rate_divisor=None):
+    """Render a rough version of the mix from start_millis to end_millis, quickly.
+
+    It's rendered at 1/draft_rate_divisor of the mix frame rate, in mono
+    unless mono is False, with nearest neighbour resampling and a batch of
+    grains at a time (see add_draft_grains), and only with the grains that
+    start in the range, so tails from before it are missing. Returns a
+    MixBus of the range.
+    """
+    frame_rate, _ = get_mix_format(folders)
+    draft_rate = frame_rate // (rate_divisor or draft_rate_divisor)
+    end_millis = duration_in_millis if end_millis is None else min(end_millis, duration_in_millis)
+    first_frame = frame_count(start_millis, draft_rate)
+    channels = 1 if mono else 2
+    draft = MixBus(max(frame_count(end_millis, draft_rate) - first_frame, 0), draft_rate, channels)
+    plan = get_formula_plan(all_folders)
+    for folder in sounding_folders(folders):
+        batches = iter_folder_batches(plan, all_folders.index(folder), duration_in_millis, start_millis, end_millis)
+        for onsets, values in batches:
+            add_draft_grains(draft.buffer, folder.audio_files, onsets, values, draft_rate, first_frame)
+    return draft
+
+# How far ahead of the playhead PreviewPlayer renders when the mix is too
+# long to render at once
+preview_ahead_millis = 30000
+# Layers of a preview, worst to best
+preview_qualities = ["window", "draft", "full"]
+
+class PreviewPlayer:
+    """Plays a draft of the mix right away and refines it while it plays.
+
+    start() renders a draft of window_millis from start_millis (see
+    render_draft) and starts playing it. In the background a draft of the
+    rest of the piece follows, then the full quality mix from render_blocks.
+    The callback always plays the best of them that covers the playhead, so
+    the sound gets better as it plays without stopping. The full render
+    goes through the stem cache like any other, so an export after it is a
+    re-mix. Rendering is checked for stop() between blocks, and stop()
+    waits for it to end. Formula edits are heard on the next play.
+
+    A piece that render_mix can't do within export_buffer_bytes is refined
+    in pieces instead: drafts window_millis at a time and the full mix
+    streamed from render_blocks, both kept at most preview_ahead_millis
+    ahead of the playhead, and whatever the playhead has passed is dropped.
+    """
+
+    def __init__(self, folders, all_folders, duration_in_millis, start_millis=0, window_millis=10000, mono=True, on_finish=None):
+        self.folders = list(folders)
+        self.all_folders = all_folders
+        self.duration_in_millis = duration_in_millis
+        self.start_millis = min(start_millis, duration_in_millis)
+        self.window_millis = window_millis
+        self.mono = mono
+        self.on_finish = on_finish
+        self.frame_rate, self.sample_width = get_mix_format(folders)
+        self.total_frames = frame_count(duration_in_millis, self.frame_rate)
+        self.position = frame_count(self.start_millis, self.frame_rate)
+        # (buffer, frame rate, first frame at that rate, quality), worst to best
+        self.layers = []
+        self.best = None
+        self.stage_seconds = {}
+        self.underruns = 0
+        self.stopping = threading.Event()
+        self.close_lock = threading.Lock()
+        self.stream = None
+        self.audio = None
+        self.refiner = None
+
+    def add_layer(self, buffer, frame_rate, first_frame, quality):
+        # Swapped in whole, the callback reads the list without a lock
+        position = self.position
+        layers = [layer for layer in self.layers if (layer[2] + len(layer[0])) * self.frame_rate // layer[1] > position]
+        layers.append((buffer, frame_rate, first_frame, quality))
+        self.layers = sorted(layers, key=lambda layer: preview_qualities.index(layer[3]))
+        if self.best is None or preview_qualities.index(quality) > preview_qualities.index(self.best):
+            self.best = quality
+
+    def add_draft(self, quality, start_millis, end_millis):
+        started = perf_counter()
+        draft = render_draft(self.folders, self.duration_in_millis, self.all_folders, start_millis, end_millis, self.mono)
+        self.add_layer(draft.buffer, draft.frame_rate, frame_count(start_millis, draft.frame_rate), quality)
+        self.stage_seconds[quality] = self.stage_seconds.get(quality, 0.0) + perf_counter() - started
+
+    def refine(self):
+        try:
+            if render_mix_bytes(self.folders, self.duration_in_millis, self.all_folders) <= export_buffer_bytes:
+                if self.start_millis + self.window_millis < self.duration_in_millis and not self.stopping.is_set():
+                    self.add_draft("draft", self.start_millis + self.window_millis, self.duration_in_millis)
+                if not self.stopping.is_set():
+                    self.refine_full()
+            else:
+                self.refine_ahead()
+        except Exception as error:
+            # Keep playing the drafts
+            self.stage_seconds["error"] = f"{type(error).__name__}: {error}"
+
+    def refine_full(self):
+        started = perf_counter()
+        # Block by block rather than with render_mix, so stop() doesn't wait for the whole piece
+        full = np.empty((self.total_frames, 2), dtype=np.float32)
+        blocks = render_blocks(self.folders, self.duration_in_millis, self.all_folders, export_block_frames)
+        try:
+            block_start = 0
+            for block in blocks:
+                if self.stopping.is_set():
+                    return
+                full[block_start:block_start + len(block)] = block
+                block_start += len(block)
+        finally:
+            blocks.close()
+        self.add_layer(full, self.frame_rate, 0, "full")
+        self.stage_seconds["full"] = perf_counter() - started
+
+    def refine_ahead(self):
+        ahead_frames = frame_count(preview_ahead_millis, self.frame_rate)
+        draft_end = self.start_millis + self.window_millis
+        started = perf_counter()
+        # The full mix can only be rendered from the beginning, blocks before the playhead are dropped
+        blocks = render_blocks(self.folders, self.duration_in_millis, self.all_folders, export_block_frames, collect=False)
+        try:
+            block_start = 0
+            for block in blocks:
+                if self.stopping.is_set():
+                    return
+                if block_start < self.position + ahead_frames:
+                    # Drafts cover the playhead until the full mix catches up with it
+                    playhead_millis = self.position * 1000 // self.frame_rate
+                    while draft_end < min(playhead_millis + preview_ahead_millis, self.duration_in_millis) and not self.stopping.is_set():
+                        self.add_draft("draft", draft_end, draft_end + self.window_millis)
+                        draft_end += self.window_millis
+                if block_start + len(block) > self.position:
+                    self.add_layer(block, self.frame_rate, block_start, "full")
+                block_start += len(block)
+                while block_start > self.position + ahead_frames and not self.stopping.is_set():
+                    self.stopping.wait(0.05)
+        finally:
+            blocks.close()
+            self.stage_seconds["full"] = perf_counter() - started
+
+    def read(self, out):
+        """Fill out with the best layers from the playhead on; returns how many frames they covered."""
+        filled = 0
+        while filled < len(out):
+            count = self.read_layer(out[filled:], self.position + filled)
+            if not count:
+                break
+            filled += count
+        return filled
+
+    def read_layer(self, out, position):
+        for buffer, frame_rate, first_frame, _ in reversed(self.layers):
+            indices = (np.arange(position, position + len(out)) * frame_rate // self.frame_rate) - first_frame
+            count = np.searchsorted(indices, len(buffer))
+            if count and indices[0] >= 0:
+                # Drafts are held, not interpolated, and mono ones go to both sides
+                out[:count] = buffer[indices[:count]]
+                return count
+        return 0
+
+    def callback(self, in_data, frame_count, time_info, status):
+        out = np.zeros((frame_count, 2), dtype=np.float32)
+        count = self.read(out[:max(min(frame_count, self.total_frames - self.position), 0)])
+        if status or count < min(frame_count, self.total_frames - self.position):
+            self.underruns += 1
+        self.position += frame_count
+        finished = self.position >= self.total_frames
+        if finished or self.stopping.is_set():
+            threading.Thread(target=self.close, daemon=True).start()
+        flag = self.pyaudio.paComplete if finished or self.stopping.is_set() else self.pyaudio.paContinue
+        return float_to_pcm(out, self.sample_width).tobytes(), flag
+
+    def start(self):
+        import pyaudio
+        self.pyaudio = pyaudio
+
+        self.add_draft("window", self.start_millis, self.start_millis + self.window_millis)
+        self.refiner = threading.Thread(target=self.refine, daemon=True)
+        self.refiner.start()
+        self.audio = pyaudio.PyAudio()
+        self.stream = self.audio.open(format=self.audio.get_format_from_width(self.sample_width),
+                                      channels=2,
+                                      rate=self.frame_rate,
+                                      output=True,
+                                      frames_per_buffer=1024,
+                                      stream_callback=self.callback)
+
+    def stop(self):
+        self.stopping.set()
+        self.close()
+        # The refiner gives up within a block, wait for it so the next play doesn't render alongside it
+        if self.refiner is not None and self.refiner is not threading.current_thread():
+            self.refiner.join()
+
+    def close(self):
+        with self.close_lock:
+            if self.stream is None:
+                return
+            self.stream.stop_stream()
+            self.stream.close()
+            self.audio.terminate()
+            self.stream = None
+        if self.on_finish is not None:
+            self.on_finish(self)
+
+    def quality(self):
+        """Name of the best layer so far: window, draft or full."""
+        return self.best
+
+    def report(self):
+        return {
+            "played_seconds": (self.position - frame_count(self.start_millis, self.frame_rate)) / self.frame_rate,
+            "underruns": self.underruns,
+            "quality": self.quality(),
+            "stage_seconds": dict(self.stage_seconds),
+        }
 
-def fill_audio_based_on_formula(audios, select_formula, gap_formula, playback_speed_formula, start_formula, duration_formula, duration_in_millis, all_folders):
-    result = AudioSegment.silent(duration=duration_in_millis)
-    t_millis = 0
-    audio_for_t = AudioSegment.silent(duration=0) 
-    while t_millis < duration_in_millis:
-        audio_for_t = get_audio_for_time(audios, select_formula, t_millis)
-
-        audio_for_t = extract_grain(audio_for_t, start_formula, duration_formula, t_millis, all_folders)
-        
-        # Get fade-in and fade-out percentages
-        fade_in_percent = evaluate_formula(current_folder.formulas["fade_in"], t_millis, all_folders)
-        fade_out_percent = evaluate_formula(current_folder.formulas["fade_out"], t_millis, all_folders)
-        
-        # Apply the Hann window with fade-in and fade-out
-        windowed_grain = apply_hann_window(audio_for_t, fade_in_percent, fade_out_percent)
-        
-        # Apply time-playback_speeding
-        playback_speed_factor = evaluate_formula(playback_speed_formula, t_millis, all_folders)
-        audio_for_t = time_playback_speed(windowed_grain, playback_speed_factor)
-        
-        # Ensure the audio is in stereo format
-        if audio_for_t.channels == 1:
-            audio_for_t = audio_for_t.set_channels(2)
-        
-        # Apply panning
-        pan_value = evaluate_formula(current_folder.formulas["panning"], t_millis, all_folders)
-        audio_for_t = pan_audio(audio_for_t, pan_value)
-
-        result = result.overlay(audio_for_t, position=t_millis)
-        gap_seconds = evaluate_formula(gap_formula, t_millis, all_folders)
-        min_gap_seconds = 0.001
-        gap_seconds = max(gap_seconds, min_gap_seconds)
-        t_millis += int(gap_seconds * 1000)
-    return result
+def frame_count(t_millis, frame_rate):
+    return int(t_millis * frame_rate / 1000)
+
+def get_mix_format(folders):
+    """Return the (frame_rate, sample_width) a mix of these folders is rendered at.
+
+    Like AudioSegment.overlay, the mix uses the highest frame rate and sample
+    width of the material in it.
+    """
+    frame_rate, sample_width = 11025, 2  # AudioSegment.silent defaults
+    for folder in folders:
+        for audio in folder.audio_files:
+            frame_rate = max(frame_rate, audio.frame_rate)
+            sample_width = max(sample_width, audio.sample_width)
+    return frame_rate, sample_width
+
+def sounding_folders(folders):
+    """Return the folders that have samples; ones still loading or with nothing readable are silent."""
+    return [folder for folder in folders if folder.audio_files]
+
+def full_scale(sample_width):
+    return float(1 << (8 * sample_width - 1))
+
+def mix_into(target, samples, gain=1.0):
+    """Sum samples into target in place, scaled by gain."""
+    if gain == 1.0:
+        target += samples
+    else:
+        target += samples * np.float32(gain)
+
+def float_to_pcm(samples, sample_width=2, gain=1.0):
+    """Convert float samples to integer samples, clipping anything over full scale."""
+    scale = full_scale(sample_width)
+    # float32 can't hold 2**31 - 1, it rounds up to 2**31 and would wrap around
+    float_type = np.float64 if sample_width == 4 else np.float32
+    pcm = np.multiply(samples, float_type(scale * gain), dtype=float_type)
+    np.rint(pcm, out=pcm)
+    np.clip(pcm, -scale, scale - 1, out=pcm)
+    return pcm.astype(sample_dtypes[sample_width])
+
+class MixBus:
+    """Preallocated float32 multichannel accumulator.
+
+    Grains are summed into the buffer at their frame offset in place, so the
+    cost of a render is proportional to the audio produced rather than to the
+    length of the output. Samples are floats where 1.0 is full scale.
+    """
+
+    def __init__(self, num_frames, frame_rate, channels=2, buffer=None):
+        self.frame_rate = frame_rate
+        self.channels = channels
+        if buffer is None:
+            buffer = np.zeros((num_frames, channels), dtype=np.float32)
+        self.buffer = buffer
+
+    def add(self, samples, offset_frame, gain=1.0):
+        """Sum a (frames, channels) float buffer into the bus at offset_frame."""
+        if offset_frame >= len(self.buffer):
+            return
+        samples = samples[:len(self.buffer) - offset_frame]
+        mix_into(self.buffer[offset_frame:offset_frame + len(samples)], samples, gain)
+
+    def add_grain(self, grain, gains, offset_frame):
+        add_grain(self.buffer, grain, gains, offset_frame)
+
+    def peak(self):
+        return float(np.abs(self.buffer).max()) if self.buffer.size else 0.0
+
+    def to_samples(self, sample_width=2, normalize=False):
+        """Convert the bus to interleaved integer samples of the given width.
+
+        Anything over full scale is clipped instead of wrapping around, or the
+        whole mix is scaled down to fit when normalize is set.
+        """
+        peak = self.peak()
+        gain = 1.0 / peak if normalize and peak > 1.0 else 1.0
+        return float_to_pcm(self.buffer, sample_width, gain)
+
+    def to_segment(self, sample_width=2, normalize=False):
+        return AudioSegment(
+            data=self.to_samples(sample_width, normalize).tobytes(),
+            sample_width=sample_width,
+            frame_rate=self.frame_rate,
+            channels=self.channels,
+        )
 
 
 
-def get_evaluation_context(t_millis, all_folders):
-    x_value = t_millis / 1000
-    context = {"x": x_value}
-    
-    for i, folder in enumerate(all_folders):
-        evaluation_order = get_evaluation_order(folder)
-        for formula_name in evaluation_order:
-            formula = folder.formulas[formula_name]
-            # Use a different key format that won't conflict with Python syntax
-            context_key = f"folder_{i+1}_{formula_name}"
-            context[context_key] = simple_evaluate(formula, x_value, context)
-    
-    return context
-
-# Global cache dictionary
-formula_cache = {}
-
-def simple_evaluate(formula, x_value, context):
-    # Check if result is in cache
-    cache_key = (formula, x_value)
-    if cache_key in formula_cache:
-        return formula_cache[cache_key]
-    
-    # Ensure that the formula is evaluated in the context of all previously evaluated formulas
-    result = eval(formula, {}, context)
-    
-    # Store result in cache
-    formula_cache[cache_key] = result
-    
-    return result
+# Formula compilation
+class FormulaCycleError(Exception):
+    pass
 
+# Compiled code objects, keyed by formula source
+compiled_formulas = {}
+formula_globals = {}
 
+# Matches the context names formulas use to read other folders' values
+folder_reference = re.compile(r"folder_(\d+)_(\w+)$")
 
+def context_key(folder_index, formula_name):
+    # Use a key format that won't conflict with Python syntax
+    return f"folder_{folder_index+1}_{formula_name}"
 
+def compile_formula(formula):
+    """Compile a formula string once and reuse the code object afterwards."""
+    code = compiled_formulas.get(formula)
+    if code is None:
+        code = compile(formula, "<formula>", "eval")
+        compiled_formulas[formula] = code
+    return code
 
-def apply_hann_window(audio, fade_in_percent, fade_out_percent):
-    """Apply a Hann window to the audio segment with fade-in and fade-out."""
-    num_samples = len(audio.get_array_of_samples())
-    
-    # Calculate the number of samples for fade-in and fade-out based on percentages
-    fade_in_samples = int((fade_in_percent / 100) * num_samples)
-    fade_out_samples = int((fade_out_percent / 100) * num_samples)
-    
-    # Generate the Hann window
-    hann_window = []
-    for n in range(num_samples):
-        if n < fade_in_samples:
-            window_value = 0.5 - 0.5 * math.cos(math.pi * n / fade_in_samples)
-        elif n > num_samples - fade_out_samples:
-            window_value = 0.5 - 0.5 * math.cos(math.pi * (num_samples - n) / fade_out_samples)
-        else:
-            window_value = 1
-        hann_window.append(window_value)
-    
-    # Apply the window to the audio samples
-    windowed_samples = [int(sample * window_value) for sample, window_value in zip(audio.get_array_of_samples(), hann_window)]
-    
-    # Convert the windowed samples to bytes
-    windowed_bytes = array.array(audio.array_type, windowed_samples).tobytes()
-    
-    # Convert the windowed bytes back to an AudioSegment
-    windowed_audio = audio._spawn(windowed_bytes)
-    
-    return windowed_audio
+def get_code_names(code):
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if hasattr(const, "co_names"):
+            names |= get_code_names(const)
+    return names
 
 def get_dependencies(formula):
-    """Return a list of variables (formulas) that the given formula depends on."""
-    tokens = formula.split()
-    dependencies = set()
-    for token in tokens:
-        if token in current_folder.formulas and token != "x":
-            dependencies.add(token)
-    return dependencies
+    """Return the context names (x and folder_N_param) the given formula reads."""
+    return {name for name in get_code_names(compile_formula(formula)) if name == "x" or folder_reference.match(name)}
 
-def ensure_exports_folder_exists():
-    exports_path = os.path.join(os.getcwd(), "exports")
-    if not os.path.exists(exports_path):
-        os.makedirs(exports_path)
+def resolve_evaluation_order(dependencies):
+    """Order context keys so every key comes after the keys it depends on."""
+    order = []
+    state = {}  # key -> "visiting" or "done"
+    for root in dependencies:
+        if root in state:
+            continue
+        stack = [(root, iter(sorted(dependencies[root])))]
+        state[root] = "visiting"
+        while stack:
+            key, pending = stack[-1]
+            for dependency in pending:
+                if dependency not in dependencies:
+                    continue  # x, or a reference to a folder that doesn't exist
+                if state.get(dependency) == "visiting":
+                    cycle = [k for k, _ in stack]
+                    cycle = cycle[cycle.index(dependency):] + [dependency]
+                    raise FormulaCycleError("Formulas reference each other in a cycle: " + " -> ".join(cycle))
+                if dependency not in state:
+                    state[dependency] = "visiting"
+                    stack.append((dependency, iter(sorted(dependencies[dependency]))))
+                    break
+            else:
+                stack.pop()
+                state[key] = "done"
+                order.append(key)
+    return order
 
+class FormulaPlan:
+    """Evaluation plan for the formulas of a list of folders.
+
+    Every formula is compiled once and the folder_N_param references between
+    folders are resolved once, so evaluating a tick is a single pass over
+    precompiled code.
+    """
+
+    def __init__(self, all_folders):
+        self.folders = list(all_folders)
+        self.formulas = {}
+        self.dependencies = {}
+        self.folder_keys = []
+        for i, folder in enumerate(self.folders):
+            keys = []
+            for formula_name, formula in folder.formulas.items():
+                key = context_key(i, formula_name)
+                self.formulas[key] = formula
+                self.dependencies[key] = get_dependencies(formula)
+                keys.append((formula_name, key))
+            self.folder_keys.append(keys)
+        self.order = resolve_evaluation_order(self.dependencies)
+        self.steps = [(key, self.formulas[key]) for key in self.order]
+        self.closures = {}
+
+    def closure_steps(self, keys):
+        """Return only the steps needed to evaluate the given keys, in plan order."""
+        keys = tuple(keys)
+        steps = self.closures.get(keys)
+        if steps is None:
+            needed = set()
+            pending = [key for key in keys if key in self.formulas]
+            while pending:
+                key = pending.pop()
+                if key not in needed:
+                    needed.add(key)
+                    pending.extend(d for d in self.dependencies[key] if d in self.formulas)
+            steps = [(key, formula) for key, formula in self.steps if key in needed]
+            self.closures[keys] = steps
+        return steps
+
+    def depends_on_x(self, key):
+        """True if the value of key changes over time."""
+        return any("x" in self.dependencies[k] for k, _ in self.closure_steps([key]))
+
+    def evaluate(self, t_millis, keys=None):
+        """Return the evaluation context (x and every folder_N_param) at t_millis."""
+        steps = self.steps if keys is None else self.closure_steps(keys)
+        context = {"x": t_millis / 1000}
+        for key, formula in steps:
+            context[key] = formula_cache.evaluate(formula, context)
+        return context
+
+    def evaluate_batch(self, t_millis, keys=None, scalar_fallback=True):
+        """Evaluate the plan over an array of times at once.
+
+        Returns a context of NumPy arrays. Formulas that can't be evaluated on
+        arrays fall back to the scalar path, element by element, unless
+        scalar_fallback is False, in which case FormulaNotVectorizable is raised.
+        """
+        steps = self.steps if keys is None else self.closure_steps(keys)
+        x_values = np.asarray(t_millis, dtype=np.int64) / 1000
+        context = {"x": x_values}
+        for key, formula in steps:
+            result = evaluate_vectorized(formula, context, len(x_values))
+            if result is None:
+                if not scalar_fallback:
+                    raise FormulaNotVectorizable(formula)
+                result = evaluate_elementwise(formula, context, len(x_values))
+            context[key] = result
+        return context
+
+    def folder_values(self, folder_index, t_millis):
+        """Return {formula_name: value} for one folder at t_millis."""
+        context = self.evaluate(t_millis)
+        return {formula_name: context[key] for formula_name, key in self.folder_keys[folder_index]}
+
+    def folder_values_batch(self, folder_index, t_millis):
+        """Return {formula_name: array} for one folder over an array of times."""
+        keys = self.folder_keys[folder_index]
+        context = self.evaluate_batch(t_millis, [key for _, key in keys])
+        return {formula_name: context[key] for formula_name, key in keys}
+
+class FormulaNotVectorizable(Exception):
+    pass
+
+def evaluate_vectorized(formula, context, size):
+    """Evaluate a formula on arrays, or return None if it only works on scalars."""
+    try:
+        with np.errstate(all="ignore"):
+            result = np.asarray(eval(compile_formula(formula), formula_globals, context))
+    except Exception:
+        # e.g. int(x), min(x, 1) or "a if x > 1 else b" on an array
+        return None
+    if result.dtype.kind not in "biuf":
+        return None
+    if result.ndim == 0:
+        return np.full(size, result.item())
+    if result.shape != (size,):
+        return None
+    if result.dtype.kind == "f" and not np.isfinite(result).all():
+        # Let the scalar path raise the ZeroDivisionError/OverflowError it would have
+        return None
+    return result
 
-def extract_grain(audio, start_formula, duration_formula, t_millis, all_folders):
-    start_percent = evaluate_formula(start_formula, t_millis, all_folders) / 100
-    duration_percent = evaluate_formula(duration_formula, t_millis, all_folders) / 100
+def evaluate_elementwise(formula, context, size):
+    code = compile_formula(formula)
+    names = [name for name in get_code_names(code) if name in context]
+    columns = [context[name].tolist() for name in names]
+    results = []
+    for i in range(size):
+        scalar_context = {name: column[i] for name, column in zip(names, columns)}
+        results.append(eval(code, formula_globals, scalar_context))
+    return np.asarray(results)
+
+def spacing_to_millis(gap_seconds):
+    """Convert spacing values (seconds) into whole-millisecond steps between grains."""
+    min_gap_seconds = 0.001
+    return (np.maximum(gap_seconds, min_gap_seconds) * 1000).astype(np.int64)
+
+def notespacing_to_millis(notespacing):
+    """Convert notespacing values (milliseconds) into steps between MIDI notes."""
+    # A note spacing of zero would never advance, so step at least a millisecond
+    return np.maximum(np.trunc(notespacing), 1).astype(np.int64)
+
+def iter_grain_onsets(plan, spacing_key, duration_in_millis, to_millis=spacing_to_millis, chunk_millis=60000):
+    """Yield arrays of grain onset times (ms), one chunk of the timeline at a time.
+
+    Each onset is the previous one plus the spacing evaluated at the previous
+    onset. A spacing that doesn't change over time is a plain arange; otherwise
+    the spacing is evaluated over every millisecond of the chunk in one batch
+    and the onsets are found by following the steps through that table.
+    """
+    if not plan.depends_on_x(spacing_key):
+        step = int(to_millis(plan.evaluate(0, [spacing_key])[spacing_key]))
+        for chunk_start in range(0, duration_in_millis, chunk_millis):
+            first = -(-chunk_start // step) * step
+            yield np.arange(first, min(chunk_start + chunk_millis, duration_in_millis), step, dtype=np.int64)
+        return
 
-    grain_start = int(start_percent * len(audio))
-    grain_end = grain_start + int(duration_percent * len(audio))
+    t_millis = 0
+    vectorized = True
+    for chunk_start in range(0, duration_in_millis, chunk_millis):
+        chunk_end = min(chunk_start + chunk_millis, duration_in_millis)
+        onsets = []
+        if vectorized:
+            try:
+                grid = np.arange(chunk_start, chunk_end, dtype=np.int64)
+                steps = to_millis(plan.evaluate_batch(grid, [spacing_key], scalar_fallback=False)[spacing_key]).tolist()
+                while t_millis < chunk_end:
+                    onsets.append(t_millis)
+                    t_millis += steps[t_millis - chunk_start]
+            except FormulaNotVectorizable:
+                vectorized = False
+        if not vectorized:
+            # Only evaluate the spacing at the onsets themselves
+            while t_millis < chunk_end:
+                onsets.append(t_millis)
+                t_millis += int(to_millis(plan.evaluate(t_millis, [spacing_key])[spacing_key]))
+        yield np.asarray(onsets, dtype=np.int64)
+
+def follow_spacing(plan, spacing_key, t_millis, end_millis, to_millis=spacing_to_millis):
+    """Return the onsets from t_millis up to end_millis, and the one after them.
+
+    The same walk through the spacing as iter_grain_onsets, for a short
+    stretch of the timeline at a time.
+    """
+    onsets = []
+    if t_millis >= end_millis:
+        return onsets, t_millis
+    grid = np.arange(t_millis, end_millis, dtype=np.int64)
+    steps = to_millis(plan.evaluate_batch(grid, [spacing_key])[spacing_key]).tolist()
+    start = t_millis
+    while t_millis < end_millis:
+        onsets.append(t_millis)
+        t_millis += steps[t_millis - start]
+    return onsets, t_millis
+
+def iter_grain_batches(plan, folder_index, duration_in_millis, spacing_name="spacing", to_millis=spacing_to_millis, start_millis=0):
+    """Yield (onsets, {formula_name: array}) for a folder, one chunk at a time.
+
+    Onsets before start_millis are still walked through, but not evaluated.
+    """
+    spacing_key = context_key(folder_index, spacing_name)
+    for onsets in iter_grain_onsets(plan, spacing_key, duration_in_millis, to_millis):
+        if start_millis:
+            onsets = onsets[onsets >= start_millis]
+        if len(onsets):
+            yield onsets, plan.folder_values_batch(folder_index, onsets)
+
+# Plans are keyed by the folders they cover and only rebuilt after a formula edit
+formula_plans = {}
+
+def get_formula_plan(all_folders):
+    plan_key = tuple(id(folder) for folder in all_folders)
+    plan = formula_plans.get(plan_key)
+    if plan is None:
+        plan = FormulaPlan(all_folders)
+        formula_plans[plan_key] = plan
+    return plan
+
+def invalidate_formula_plans():
+    formula_plans.clear()
+
+class FormulaCache:
+    """Size-bounded LRU cache of formula results.
+
+    Entries are keyed on the formula plus the values of the context names it
+    actually reads (x and folder_N_param), so a formula that references another
+    folder never returns a result computed for different upstream values.
+    The entries are behind a lock, formulas are evaluated outside it.
+    """
+
+    def __init__(self, maxsize=65536):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.names = {}  # formula -> context names its key is built from
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def evaluate(self, formula, context):
+        names = self.names.get(formula)
+        if names is None:
+            names = tuple(sorted(get_dependencies(formula)))
+            self.names[formula] = names
+        cache_key = (formula,) + tuple([context.get(name) for name in names])
+        with self.lock:
+            try:
+                result = self.entries[cache_key]
+            except KeyError:
+                self.misses += 1
+            except TypeError:
+                # Unhashable upstream value, don't cache
+                cache_key = None
+            else:
+                self.hits += 1
+                self.entries.move_to_end(cache_key)
+                return result
+
+        # Ensure that the formula is evaluated in the context of all previously evaluated formulas
+        result = eval(compile_formula(formula), formula_globals, context)
+        if cache_key is None:
+            return result
+        with self.lock:
+            self.entries[cache_key] = result
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return result
+
+    def invalidate(self, formula=None):
+        """Drop the results of one formula, or of every formula if none is given."""
+        with self.lock:
+            if formula is None:
+                self.entries.clear()
+                self.names.clear()
+                return
+            self.names.pop(formula, None)
+            for cache_key in [k for k in self.entries if k[0] == formula]:
+                del self.entries[cache_key]
+
+    def resize(self, maxsize):
+        with self.lock:
+            self.maxsize = maxsize
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
 
-    # Ensure grain_end doesn't exceed audio length
-    grain_end = min(grain_end, len(audio))
+# Global formula result cache
+formula_cache = FormulaCache()
+
+
+
+
+
+class BufferCache:
+    """LRU cache of NumPy buffers bounded by their total size in bytes.
+
+    Thread-safe, the live scheduler renders while the GUI exports.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            buffer = self.entries.get(key)
+            if buffer is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return buffer
+
+    def put(self, key, buffer):
+        if buffer.nbytes > self.max_bytes:
+            return buffer  # Too big to ever fit, just hand it back
+        buffer.setflags(write=False)
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.total_bytes -= previous.nbytes
+            self.entries[key] = buffer
+            self.total_bytes += buffer.nbytes
+            while self.total_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.total_bytes -= evicted.nbytes
+                self.evictions += 1
+        return buffer
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
 
-    grain = audio[grain_start:grain_end]
-    
-    # Get fade-in and fade-out percentages
-    if "fade_in" in current_folder.formulas:
-        fade_in_percent = evaluate_formula(current_folder.formulas["fade_in"], t_millis, all_folders)
-    else:
-        fade_in_percent = 0.01
+class GrainCache(BufferCache):
+    """BufferCache of finished grains, keyed by everything they're made of.
 
-    if "fade_out" in current_folder.formulas:
-        fade_out_percent = evaluate_formula(current_folder.formulas["fade_out"], t_millis, all_folders)
-    else:
-        fade_out_percent = 0.01
-    
-    # Apply the Hann window to the grain
-    windowed_grain = apply_hann_window(grain, fade_in_percent, fade_out_percent)
-    return windowed_grain
+    A grain is only stored the second time its key comes up, so pieces
+    where every grain is different don't spend their time filling it.
+    """
 
+    def __init__(self, max_bytes, max_seen=65536):
+        super().__init__(max_bytes)
+        self.max_seen = max_seen
+        self.seen = set()
 
+    def admit(self, key):
+        """Return True if the grain for key has come up before and should be stored."""
+        with self.lock:
+            if key in self.seen:
+                return True
+            if len(self.seen) >= self.max_seen:
+                self.seen.clear()
+            self.seen.add(key)
+            return False
 
-# Options for file formats, bitrates, and sample rates
-file_formats = ["wav", "mp3", "flac", "ogg"]
-bitrates = ["64k", "128k", "192k", "256k", "320k"]
-sample_rates = ["22050", "44100", "48000", "96000"]
+    def clear(self):
+        super().clear()
+        with self.lock:
+            self.seen.clear()
 
-class AppFrame(wx.Frame):
-
-    def add_new_folder(self, event):
-        global current_folder  # Declare current_folder as global
-        dialog = wx.DirDialog(self, "Choose a directory:", style=wx.DD_DEFAULT_STYLE)
-        if dialog.ShowModal() == wx.ID_OK:
-            path = dialog.GetPath()
-            new_folder = AudioFolder(path)
-            new_folder.load_audio_files()
-            audio_folders.append(new_folder)
-            current_folder = new_folder
-            self.folder_listbox.Append(os.path.basename(path))
-            self.folder_listbox.SetSelection(self.folder_listbox.GetCount() - 1)  # Select the last added entry
-            self.update_display()
-        dialog.Destroy()
-
-    def add_new_midi_folder(self, event):
-        global current_folder  # Declare current_folder as global
-        new_midi_folder = MidiFolder()
-        midi_folders.append(new_midi_folder)
-        current_folder = new_midi_folder
-        self.folder_listbox.Append("MIDI")
-        self.folder_listbox.SetSelection(self.folder_listbox.GetCount() - 1)  # Select the last added entry
-        self.update_display(midi=True)
-
-
-    def update_formula(self, param, event):
-        if self.updating_programmatically:
-            return
+# Window curves, keyed by (frames, fade_in_frames, fade_out_frames)
+window_cache = BufferCache(max_bytes=64 * 1024 * 1024)
 
-        if current_folder:
-            current_folder.formulas[param] = self.entries[param].GetValue().strip()
-            self.update_display()
+# Finished grains that recur, e.g. with constant formulas or samples cycling through a few files
+grain_cache = GrainCache(max_bytes=64 * 1024 * 1024)
 
+# Resampled source material for recurring playback speeds
+resampler = Resampler()
 
-    def update_display(self, midi=False):
-        if midi:
-            # Update UI for MIDI-specific parameters
-            self.updating_programmatically = True
-            for param in midi_parameters:  # Assume midi_parameters is a list of MIDI-specific parameters
-                formula = current_folder.formulas.get(param, "")  # Use current_folder, which now can be a MidiFolder
-                self.entries[param].SetValue(formula)
-            self.updating_programmatically = False
-        else:
-            if current_folder:
-                self.updating_programmatically = True
-                for param in parameters:
-                    formula = current_folder.formulas.get(param, "")
-                    self.entries[param].SetValue(formula)
-                self.updating_programmatically = False
+# Stems of earlier renders, so after an edit only the folders it affects are rendered again
+stem_cache = BufferCache(max_bytes=512 * 1024 * 1024)
 
+# Stage timings are counted in log-spaced buckets, a quarter octave wide
+# from 100 ns up (bucket 0 is anything shorter), so a stage's stats are the
+# same size however many grains it times and percentiles come from the buckets
+stats_min_seconds = 1e-7
+stats_buckets_per_octave = 4
+stats_num_buckets = 128
 
+class StageStats:
+    """Count, total, max, bytes and a timing histogram of one render stage."""
 
-    def switch_folder(self, event):
-        global current_folder  # Declare current_folder as global
-        try:
-            index = self.folder_listbox.GetSelection()
-            if self.folder_listbox.GetString(index) == "MIDI":
-                # Hide audio parameters and show MIDI parameters
-                for hbox in self.audio_boxes:
-                    hbox.ShowItems(False)
-                for hbox in self.midi_boxes:
-                    hbox.ShowItems(True)
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.bytes = 0
+        self.buckets = [0] * stats_num_buckets
+
+    def add(self, seconds, nbytes=0):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.bytes += nbytes
+        if seconds > stats_min_seconds:
+            bucket = min(int(math.log2(seconds / stats_min_seconds) * stats_buckets_per_octave) + 1, stats_num_buckets - 1)
+        else:
+            bucket = 0
+        self.buckets[bucket] += 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        self.bytes += other.bytes
+        self.buckets = [mine + theirs for mine, theirs in zip(self.buckets, other.buckets)]
+
+    def percentile(self, percent):
+        """Return the geometric middle of the bucket the percentile falls in, at most max."""
+        rank = percent / 100 * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                break
+        if bucket == 0:
+            return min(self.max, stats_min_seconds)
+        return min(self.max, stats_min_seconds * 2 ** ((bucket - 0.5) / stats_buckets_per_octave))
+
+class RenderStats:
+    """Counts, timings and bytes of each render stage.
+
+    Stages record themselves only while enabled is set, which costs a few
+    attribute lookups per grain when it isn't. Stages are "load" and
+    "decode" (samples), "formulas" (per batch), "resample", "gains" (window,
+    pan and amplitude), "mix" (per grain), "render" and "encode". Bytes are
+    what a stage produced. Each stage is a fixed size StageStats, worker
+    processes send theirs back to be merged.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.reset()
+
+    def reset(self):
+        self.stages = {}
+
+    def record(self, stage, seconds, nbytes=0):
+        stats = self.stages.get(stage)
+        if stats is None:
+            stats = self.stages[stage] = StageStats()
+        stats.add(seconds, nbytes)
+
+    def samples(self):
+        return self.stages
+
+    def merge(self, stages):
+        for stage, stats in stages.items():
+            if stage in self.stages:
+                self.stages[stage].merge(stats)
             else:
-                # Hide MIDI parameters and show audio parameters
-                for hbox in self.audio_boxes:
-                    hbox.ShowItems(True)
-                for hbox in self.midi_boxes:
-                    hbox.ShowItems(False)
-
-            self.audio_vbox.Layout()  # Explicitly update layout
-            self.midi_vbox.Layout()  # Explicitly update layout
-
-            self.Layout()  # Refresh layout
-            self.Fit()  # Adjust to content size
-            # self.Refresh()
-            # self.update_display(midi=(self.folder_listbox.GetString(index) == "MIDI"))
-        except Exception as e:
-            print(f"An error occurred: {e}")
-
+                self.stages[stage] = stats
+
+    def report(self):
+        """Return the stats as a JSON-serializable dict, slowest stage first."""
+        stages = {}
+        for stage, stats in sorted(self.stages.items(), key=lambda item: -item[1].total):
+            stages[stage] = {
+                "count": stats.count,
+                "total_seconds": stats.total,
+                "p50_seconds": stats.percentile(50),
+                "p90_seconds": stats.percentile(90),
+                "p99_seconds": stats.percentile(99),
+                "max_seconds": stats.max,
+                "bytes": stats.bytes,
+            }
+        return {
+            "stages": stages,
+            # Caches of this process, workers keep their own
+            "caches": {
+                "formulas": formula_cache.stats(),
+                "windows": window_cache.stats(),
+                "grains": grain_cache.stats(),
+                "resampled": resampler.cache.stats(),
+                "stems": stem_cache.stats(),
+            },
+        }
 
+    def summary(self, count=5):
+        """Return the slowest stages as a few lines of text."""
+        stages = self.report()["stages"]
+        total = sum(stage["total_seconds"] for stage_name, stage in stages.items() if stage_name != "render")
+        lines = []
+        for stage_name, stage in list(stages.items())[:count]:
+            share = f" ({100 * stage['total_seconds'] / total:.0f}%)" if total and stage_name != "render" else ""
+            lines.append(f"{stage_name}: {stage['total_seconds']:.2f} s{share} over {stage['count']} calls")
+        return "\n".join(lines)
+
+    def write_report(self, path):
+        with open(path, "w") as report_file:
+            json.dump(self.report(), report_file, indent=4)
+
+# Set DEINING_STATS=1 or enabled = True to collect stats
+render_stats = RenderStats(enabled=bool(os.environ.get("DEINING_STATS")))
+
+def get_hann_window(num_frames, fade_in_frames, fade_out_frames):
+    """Return the (read-only) Hann fade curve for a grain shape."""
+    window_key = (num_frames, fade_in_frames, fade_out_frames)
+    window = window_cache.get(window_key)
+    if window is None:
+        window = np.ones(num_frames)
+        if fade_in_frames > 0:
+            n = np.arange(min(fade_in_frames, num_frames))
+            window[n] = 0.5 - 0.5 * np.cos(np.pi * n / fade_in_frames)
+        if fade_out_frames > 0:
+            n = np.arange(max(num_frames - fade_out_frames + 1, fade_in_frames, 0), num_frames)
+            window[n] = 0.5 - 0.5 * np.cos(np.pi * (num_frames - n) / fade_out_frames)
+        window = window_cache.put(window_key, window)
+    return window
+
+def apply_window_in_place(samples, fade_in_percent, fade_out_percent):
+    """Apply the Hann fade-in and fade-out to a (frames, channels) float buffer in place."""
+    num_frames = len(samples)
+
+    # Calculate the number of frames for fade-in and fade-out based on percentages
+    fade_in_frames = int((fade_in_percent / 100) * num_frames)
+    fade_out_frames = int((fade_out_percent / 100) * num_frames)
+
+    # One window value per frame, shared by every channel of that frame
+    samples *= get_hann_window(num_frames, fade_in_frames, fade_out_frames)[:, np.newaxis]
+    return samples
+
+# NumPy types of pydub's sample widths
+sample_dtypes = {1: np.int8, 2: np.int16, 4: np.int32}
+
+def segment_samples(audio):
+    """Return a read-only (frames, channels) view of the segment's samples without copying."""
+    return np.frombuffer(audio.raw_data, dtype=sample_dtypes[audio.sample_width]).reshape(-1, audio.channels)
 
+def apply_hann_window(audio, fade_in_percent, fade_out_percent):
+    """Apply a Hann window to the audio segment with fade-in and fade-out.
 
+    For library use, the render paths window grains in place.
+    """
+    samples = segment_samples(audio).astype(np.float64)
+    apply_window_in_place(samples, fade_in_percent, fade_out_percent)
 
-    def export(self, event):
-        ensure_exports_folder_exists()
-        duration = self.duration_spin.GetValue()
-        combined_audio = AudioSegment.silent(duration=int(duration * 1000))
-        for folder in audio_folders:
-            folder_audio = fill_audio_based_on_formula(
-            folder.audio_files, 
-            folder.formulas["sample"], 
-            folder.formulas["spacing"], 
-            folder.formulas["playback_speed"], 
-            folder.formulas["start"], 
-            folder.formulas["duration"], 
-            int(duration * 1000),
-            audio_folders  # Pass all folders here
-        )
-            amplitude_multiplier = evaluate_formula(folder.formulas["amplitude"], int(duration * 1000), audio_folders)
-            gain_db = multiplier_to_db(amplitude_multiplier)
-            folder_audio = folder_audio.apply_gain(gain_db)
-            combined_audio = combined_audio.overlay(folder_audio)
+    # Convert the windowed samples back to an AudioSegment
+    windowed_bytes = samples.astype(sample_dtypes[audio.sample_width]).tobytes()
+    return audio._spawn(windowed_bytes)
 
-        current_time_str = datetime.now().strftime("%Y%m%d_%H%M%S")
-        exports_path = os.path.join(os.getcwd(), "exports")
-        filename = os.path.join(exports_path, f"combined_output_{current_time_str}." + self.format_dropdown.GetStringSelection())
-        
-        generate_midi_based_on_formula(int(duration * 1000), midi_folders, f"{current_time_str}.mid")
+def ensure_exports_folder_exists():
+    exports_path = os.path.join(os.getcwd(), "exports")
+    if not os.path.exists(exports_path):
+        os.makedirs(exports_path)
 
-        combined_audio.export(filename, format=self.format_dropdown.GetStringSelection(), bitrate=self.bitrate_dropdown.GetStringSelection(), parameters=["-ar", str(self.sample_rate_dropdown.GetStringSelection())])
-        wx.MessageBox(f"Audio files combined and saved as '{filename}'", 'Info', wx.OK | wx.ICON_INFORMATION)
 
+def grain_frames(sample, start_value, duration_value):
+    """Return the (start_frame, end_frame) of a grain within its sample."""
+    start_percent = start_value / 100
+    duration_percent = duration_value / 100
 
-    def __init__(self, parent, title):
-        super(AppFrame, self).__init__(parent, title=title, size=(900, 600))
-        self.playing_audio = False
-        self.InitUI()
+    grain_start = int(start_percent * len(sample))
+    grain_end = grain_start + int(duration_percent * len(sample))
 
-    def play_audio(self, event):
-        threading.Thread(target=self.play_audio_in_thread).start()
+    # Ensure grain_end doesn't exceed audio length
+    grain_end = min(grain_end, len(sample))
 
-    def stop_audio(self, event):
-        self.playing_audio = False 
+    return sample.millis_to_frames(grain_start, grain_end)
 
-    def make_lambda(p):
-        return lambda event: self.update_formula(p, event)
 
-    def play_audio_in_thread(self):
-        self.playing_audio = True  # Set to True when starting playback
-        audio_to_play = self.generate_preview_audio()
 
-        p = pyaudio.PyAudio()
-        stream = p.open(format=p.get_format_from_width(audio_to_play.sample_width),
-                        channels=audio_to_play.channels,
-                        rate=audio_to_play.frame_rate,
-                        output=True)
+# Options for file formats, bitrates, and sample rates
+file_formats = ["wav", "mp3", "flac", "ogg"]
+bitrates = ["64k", "128k", "192k", "256k", "320k"]
+sample_rates = ["22050", "44100", "48000", "96000"]
 
-        # Stream the audio in chunks
-        for chunk in audio_to_play[::1024]:
-            if not self.playing_audio:
+default_settings = {
+    "duration": 120,  # Seconds
+    "format": "wav",
+    "bitrate": "128k",
+    "sample_rate": "44100",
+}
+
+def save_project(path, audio_folders, midi_folders, settings):
+    """Save folders, formulas and export settings as a JSON project file."""
+    project = dict(default_settings, **settings)
+    project["audio_folders"] = [{"path": folder.path, "formulas": folder.formulas} for folder in audio_folders]
+    project["midi_folders"] = [{"formulas": folder.formulas} for folder in midi_folders]
+    with open(path, "w") as project_file:
+        json.dump(project, project_file, indent=4)
+
+def load_project(path, load_samples=True):
+    """Load a project file, returns (audio_folders, midi_folders, settings).
+
+    Folder paths are relative to the project file unless they're absolute.
+    Formulas missing from the file keep their defaults. Without load_samples
+    the audio folders come back empty, to be loaded with a FolderLoader.
+    """
+    with open(path) as project_file:
+        project = json.load(project_file)
+    base = os.path.dirname(os.path.abspath(path))
+    settings = {key: project.get(key, value) for key, value in default_settings.items()}
+
+    loaded_audio_folders = []
+    for entry in project.get("audio_folders", []):
+        folder = AudioFolder(os.path.join(base, entry["path"]))
+        folder.formulas.update(entry.get("formulas", {}))
+        if load_samples:
+            folder.load_audio_files()
+        loaded_audio_folders.append(folder)
+
+    loaded_midi_folders = []
+    for entry in project.get("midi_folders", []):
+        folder = MidiFolder()
+        folder.formulas.update(entry.get("formulas", {}))
+        loaded_midi_folders.append(folder)
+    return loaded_audio_folders, loaded_midi_folders, settings
+
+# Formats that ignore the bitrate
+lossless_formats = {"wav", "flac"}
+# ffmpeg's names for the PCM fed to the encoders, by sample width
+pcm_formats = {1: "s8", 2: "s16le", 4: "s32le"}
+# Mixes up to this size are rendered in one go, in parallel, and streamed
+# to the encoders from memory; longer ones are rendered block by block
+export_buffer_bytes = 256 * 1024 * 1024
+export_block_frames = 65536
+
+def as_list(value):
+    return list(value) if isinstance(value, (list, tuple)) else [value]
+
+def get_export_targets(settings, filename):
+    """Return (path, format, bitrate, sample_rate) for every file the settings ask for.
+
+    format, bitrate and sample_rate can each be one value or a list, and
+    every combination is exported. The extension of filename is replaced
+    by each format's, and when several sample rates or bitrates are
+    exported they're added to the names.
+    """
+    base = os.path.splitext(filename)[0]
+    sample_rates = as_list(settings["sample_rate"])
+    bitrates = as_list(settings["bitrate"])
+    targets = []
+    for file_format in as_list(settings["format"]):
+        for sample_rate in sample_rates:
+            for bitrate in bitrates[:1] if file_format in lossless_formats else bitrates:
+                name = base
+                if len(sample_rates) > 1:
+                    name += f"_{sample_rate}"
+                if len(bitrates) > 1 and file_format not in lossless_formats:
+                    name += f"_{bitrate}"
+                targets.append((f"{name}.{file_format}", file_format, bitrate, str(sample_rate)))
+    return targets
+
+class Encoder:
+    """An ffmpeg process encoding the PCM written to it into one file.
+
+    Writes go through a short queue to a thread per encoder, so all
+    encoders run at once and a slow one doesn't hold up the others until
+    its queue is full.
+    """
+
+    def __init__(self, path, file_format, bitrate, sample_rate, input_rate, sample_width):
+        self.path = path
+        command = [ffmpeg_path, "-y", "-loglevel", "error",
+                   "-f", pcm_formats[sample_width], "-ar", str(input_rate), "-ac", "2", "-i", "pipe:0",
+                   "-f", file_format]
+        if file_format == "ogg":
+            command += ["-acodec", "libvorbis"]  # Like pydub picks for ogg
+        if file_format not in lossless_formats:
+            command += ["-b:a", bitrate]
+        command += ["-ar", str(sample_rate), path]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        self.blocks = queue.Queue(maxsize=4)
+        self.failed = False
+        self.writer = threading.Thread(target=self.write_blocks, daemon=True)
+        self.writer.start()
+
+    def write(self, data):
+        if not self.failed:
+            self.blocks.put(data)
+
+    def write_blocks(self):
+        while True:
+            data = self.blocks.get()
+            if data is None:
                 break
-            stream.write(chunk._data)
-
-        stream.stop_stream()
-        stream.close()
-        p.terminate()
-
-    def generate_preview_audio(self):
-        duration = self.duration_spin.GetValue()
-        combined_audio = AudioSegment.silent(duration=int(duration * 1000))
-        for folder in audio_folders:
-            folder_audio = fill_audio_based_on_formula(
-            folder.audio_files, 
-            folder.formulas["sample"], 
-            folder.formulas["spacing"], 
-            folder.formulas["playback_speed"], 
-            folder.formulas["start"], 
-            folder.formulas["duration"], 
-            int(duration * 1000),
-            audio_folders  # Pass all folders here
-        )
-            amplitude_multiplier = evaluate_formula(folder.formulas["amplitude"], int(duration * 1000))
-            gain_db = multiplier_to_db(amplitude_multiplier)
-            folder_audio = folder_audio.apply_gain(gain_db)
-            combined_audio = combined_audio.overlay(folder_audio)
-        return combined_audio
-
-    def InitUI(self):
-        panel = wx.Panel(self)
-        vbox = wx.BoxSizer(wx.VERTICAL)
-        
-        
-        # Top layout
-        hbox1 = wx.BoxSizer(wx.HORIZONTAL)
-
-        # Add Folder button
-        select_button = wx.Button(panel, label='Add Audio')
-        select_button.Bind(wx.EVT_BUTTON, self.add_new_folder)
-        hbox1.Add(select_button, flag=wx.RIGHT, border=10)
-
-        select_midi_button = wx.Button(panel, label='Add MIDI')
-        select_midi_button.Bind(wx.EVT_BUTTON, self.add_new_midi_folder)
-        hbox1.Add(select_midi_button, flag=wx.RIGHT, border=10)
-
-        # Duration label and spinbox
-        duration_label = wx.StaticText(panel, label='Duration:')
-        hbox1.Add(duration_label, flag=wx.RIGHT, border=10)
-
-        self.duration_spin = wx.SpinCtrl(panel, value='120', min=1, max=10000)
-        hbox1.Add(self.duration_spin, flag=wx.RIGHT, border=10)
-
-        seconds_label = wx.StaticText(panel, label='s')
-        hbox1.Add(seconds_label, flag=wx.RIGHT, border=10)
-
-        # Dropdowns for format, bitrate, and sample rate
-        self.format_dropdown = wx.Choice(panel, choices=file_formats)
-        hbox1.Add(self.format_dropdown, flag=wx.RIGHT, border=10)
-
-        self.bitrate_dropdown = wx.Choice(panel, choices=bitrates)
-        hbox1.Add(self.bitrate_dropdown, flag=wx.RIGHT, border=10)
-
-        self.sample_rate_dropdown = wx.Choice(panel, choices=sample_rates)
-        hbox1.Add(self.sample_rate_dropdown, flag=wx.RIGHT, border=10)
-
-        self.playback_button = wx.Button(panel, label='Play')
-        self.playback_button.Bind(wx.EVT_BUTTON, self.play_audio)
-        hbox1.Add(self.playback_button, flag=wx.RIGHT, border=10)  # Added border here
-
-        stop_button = wx.Button(panel, label='Stop')
-        stop_button.Bind(wx.EVT_BUTTON, self.stop_audio)
-        hbox1.Add(stop_button, flag=wx.RIGHT, border=10)
-
-        # Export button
-        export_button = wx.Button(panel, label='Export')
-        export_button.Bind(wx.EVT_BUTTON, self.export)
-        hbox1.Add(export_button)
-
-        vbox.Add(hbox1, flag=wx.EXPAND|wx.LEFT|wx.RIGHT|wx.TOP, border=10)
-
-        # Folder listbox
-        self.folder_listbox = wx.ListBox(panel)
-        self.folder_listbox.Bind(wx.EVT_LISTBOX, self.switch_folder)
-        vbox.Add(self.folder_listbox, proportion=1, flag=wx.EXPAND|wx.LEFT|wx.RIGHT|wx.TOP, border=10)
-
-        self.format_dropdown.SetSelection(0)  # Default to 'wav'
-        self.bitrate_dropdown.SetSelection(1)  # Default to '128k'
-        self.sample_rate_dropdown.SetSelection(1)  # Default to '44100'
-
-        self.audio_vbox = wx.BoxSizer(wx.VERTICAL)
-        self.midi_vbox = wx.BoxSizer(wx.VERTICAL)
-
-        # Parameters entries
-        self.entries = {}
-        self.audio_boxes = []  # List to hold audio parameter boxes
-        self.midi_boxes = []  # List to hold MIDI parameter boxes
-
-        for param in parameters:  # Loop for audio parameters
-            hbox = wx.BoxSizer(wx.HORIZONTAL)
-            label = wx.StaticText(panel, label=param.capitalize())
-            hbox.Add(label, flag=wx.RIGHT, border=10)
-            entry = wx.TextCtrl(panel, size=(200, -1))
-            entry.Bind(wx.EVT_TEXT, lambda event, p=param: self.update_formula(p, event))
-            hbox.Add(entry)
-            self.entries[param] = entry
-            self.audio_boxes.append(hbox)
-            self.audio_vbox.Add(hbox, flag=wx.EXPAND|wx.LEFT|wx.RIGHT|wx.TOP, border=10)
-            hbox.ShowItems(True)  # Hide MIDI parameters initially
-
-        for param in midi_parameters:  # Loop for MIDI parameters
-            hbox = wx.BoxSizer(wx.HORIZONTAL)
-            label = wx.StaticText(panel, label=param.capitalize())
-            hbox.Add(label, flag=wx.RIGHT, border=10)
-            entry = wx.TextCtrl(panel, size=(200, -1))
-            entry.Bind(wx.EVT_TEXT, lambda event, p=param: self.update_formula(p, event))
-            hbox.Add(entry)
-            self.entries[param] = entry
-            self.midi_boxes.append(hbox)
-            self.midi_vbox.Add(hbox, flag=wx.EXPAND|wx.LEFT|wx.RIGHT|wx.TOP, border=10)
-            hbox.ShowItems(True)  # Hide MIDI parameters initially
-
-        # Add audio and MIDI vertical box sizers to the main vertical box sizer
-        vbox.Add(self.audio_vbox, flag=wx.EXPAND|wx.LEFT|wx.RIGHT|wx.TOP, border=10)
-        vbox.Add(self.midi_vbox, flag=wx.EXPAND|wx.LEFT|wx.RIGHT|wx.TOP, border=10)
-
-        panel.SetSizer(vbox)
-        self.updating_programmatically = False
-
-        self.Centre()
-        self.Show(True)
-
-        
-
-
-app = wx.App()
-AppFrame(None, 'Deining.V1')
-app.MainLoop()
\ No newline at end of file
+            if self.failed:
+                continue
+            try:
+                self.process.stdin.write(data)
+            except OSError:
+                self.failed = True  # ffmpeg quit, its error message says why
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+
+    def close(self):
+        """Wait for the file to be finished, returns an error message if it failed."""
+        self.blocks.put(None)
+        self.writer.join()
+        errors = self.process.stderr.read().decode(errors="replace").strip()
+        if self.process.wait() != 0:
+            return f"{os.path.basename(self.path)}: {errors or 'ffmpeg failed'}"
+        return None
+
+    def abort(self):
+        self.failed = True
+        self.process.kill()
+        self.close()
+
+def render_mix_bytes(folders, duration_in_millis, all_folders, workers=None, score=None):
+    """Return about how much memory render_mix needs for these folders.
+
+    That's the mix plus the stems being rendered at the same time: every
+    folder that isn't in the stem cache when they render in parallel, one
+    when they render one after another. Stems going into the stem cache are
+    left out, the cache has a budget of its own.
+    """
+    frame_rate, _ = get_mix_format(folders)
+    stem_bytes = frame_count(duration_in_millis, frame_rate) * 2 * 4
+    plan = get_formula_plan(all_folders)
+    missing = sum(get_stem_key(plan, all_folders.index(folder), duration_in_millis, frame_rate, score) not in stem_cache.entries for folder in sounding_folders(folders))
+    if workers is None:
+        workers = render_workers or os.cpu_count() or 1
+    rendering = missing if workers > 1 else min(missing, 1)
+    return stem_bytes * (1 + rendering)
+
+def iter_export_blocks(folders, duration_in_millis, all_folders, workers=None, score=None):
+    """Yield the mix in blocks of export_block_frames for the encoders.
+
+    When render_mix fits in export_buffer_bytes the mix is rendered with it,
+    in parallel, otherwise it is streamed from render_blocks without
+    collecting stems, so memory doesn't grow with the length. Both give the
+    same samples.
+    """
+    if render_mix_bytes(folders, duration_in_millis, all_folders, workers, score) <= export_buffer_bytes:
+        mix, _ = render_mix(folders, duration_in_millis, all_folders, workers=workers, score=score)
+        for block_start in range(0, len(mix.buffer), export_block_frames):
+            yield mix.buffer[block_start:block_start + export_block_frames]
+    else:
+        yield from render_blocks(folders, duration_in_millis, all_folders, export_block_frames, score, collect=False)
+
+def export_mix(audio_folders, settings, filename, workers=None, score=None):
+    """Render the audio folders once and encode the mix into every file the settings ask for.
+
+    The PCM is streamed to one ffmpeg per file, see get_export_targets for
+    the file names. Returns the paths written. With a GrainScore the grains
+    come from it instead of the formulas. With render_stats enabled, the
+    stats collected since its last reset are written next to them as
+    <name>.stats.json.
+    """
+    frame_rate, sample_width = get_mix_format(audio_folders)
+    targets = get_export_targets(settings, filename)
+    encoders = [Encoder(path, file_format, bitrate, sample_rate, frame_rate, sample_width) for path, file_format, bitrate, sample_rate in targets]
+    render_seconds = 0.0
+    pcm_bytes = 0
+    try:
+        blocks = iter_export_blocks(audio_folders, int(settings["duration"] * 1000), audio_folders, workers, score)
+        while True:
+            started = perf_counter()
+            block = next(blocks, None)
+            render_seconds += perf_counter() - started
+            if block is None:
+                break
+            data = float_to_pcm(block, sample_width).tobytes()
+            pcm_bytes += len(data)
+            for encoder in encoders:
+                encoder.write(data)
+    except BaseException:
+        for encoder in encoders:
+            encoder.abort()
+        raise
+    # The encoders have been working all along, this waits for the slowest
+    started = perf_counter()
+    failures = [message for message in (encoder.close() for encoder in encoders) if message]
+    if render_stats.enabled:
+        render_stats.record("render", render_seconds, pcm_bytes)
+        render_stats.record("encode", perf_counter() - started, pcm_bytes * len(encoders))
+        render_stats.write_report(os.path.splitext(filename)[0] + ".stats.json")
+    if failures:
+        raise RuntimeError("Export failed:\n" + "\n".join(failures))
+    return [path for path, _, _, _ in targets]
+
+def render_project(path, output=None, midi_output=None, workers=None, duration=None, overrides=None, score_path=None):
+    """Render a project file without the GUI, returns the exported file names.
+
+    overrides replaces project settings, e.g. {"format": ["wav", "mp3"]}.
+    With score_path the audio is rendered from that grain score, and its
+    duration, instead of from the formulas.
+    """
+    render_stats.reset()
+    project_audio_folders, project_midi_folders, settings = load_project(path)
+    score = None
+    if score_path is not None:
+        score = GrainScore.load(score_path)
+        if len(score.tables) != len(project_audio_folders):
+            raise ValueError(f"{score_path} has {len(score.tables)} folders, {path} has {len(project_audio_folders)}")
+        settings["duration"] = score.duration_in_millis / 1000
+    elif duration is not None:
+        settings["duration"] = duration
+    settings.update(overrides or {})
+    if output is None:
+        ensure_exports_folder_exists()
+        name = os.path.splitext(os.path.basename(path))[0]
+        current_time_str = datetime.now().strftime("%Y%m%d_%H%M%S")
+        output = os.path.join(os.getcwd(), "exports", f"{name}_{current_time_str}.{as_list(settings['format'])[0]}")
+
+    exported = []
+    if project_audio_folders:
+        exported += export_mix(project_audio_folders, settings, output, workers, score)
+    # All MIDI folders go into one file next to the audio, a track each
+    if project_midi_folders:
+        midi_filename = os.path.abspath(midi_output or os.path.splitext(output)[0] + ".mid")
+        generate_midi_based_on_formula(int(settings["duration"] * 1000), project_midi_folders, midi_filename)
+        exported.append(midi_filename)
+    return exported
+
+def score_project(path, output, duration=None):
+    """Evaluate a project's formulas into a grain score file, returns the score."""
+    project_audio_folders, _, settings = load_project(path)
+    if duration is not None:
+        settings["duration"] = duration
+    score = GrainScore.from_folders(project_audio_folders, int(settings["duration"] * 1000))
+    score.save(output)
+    return score
+
+def apply_formula_overrides(folders, overrides):
+    """Set formulas given as {"folder_N_param": formula}, like formulas refer to each other.
+
+    Returns the formulas they replaced, in the same form.
+    """
+    # Every key is checked before any formula changes, so a bad one leaves them all as they were
+    targets = []
+    for key in overrides:
+        match = re.fullmatch(r"folder_(\d+)_(\w+)", key)
+        if match is None or not 1 <= int(match.group(1)) <= len(folders) or match.group(2) not in folders[int(match.group(1)) - 1].formulas:
+            raise ValueError(f"{key} isn't a formula of this project")
+        targets.append((key, folders[int(match.group(1)) - 1], match.group(2)))
+    replaced = {}
+    for key, folder, formula_name in targets:
+        replaced.setdefault(key, folder.formulas[formula_name])
+        folder.formulas[formula_name] = overrides[key]
+    invalidate_formula_plans()
+    return replaced
+
+def check_formula_overrides(folders, overrides):
+    """Raise if overrides don't name formulas of the folders, don't compile or make a cycle.
+
+    The folders' formulas are left as they were.
+    """
+    replaced = {}
+    try:
+        replaced = apply_formula_overrides(folders, overrides)
+        for formula in overrides.values():
+            compile_formula(formula)
+        FormulaPlan(folders)
+    finally:
+        apply_formula_overrides(folders, replaced)
+
+# Stems of the next sweep variants are rendered while the current one is
+# exported, in up to this much shared memory
+sweep_ahead_bytes = 256 * 1024 * 1024
+
+def render_sweep(path, variants, output_dir=None, workers=None):
+    """Render variants of a project's audio in one session, returns a summary per variant.
+
+    variants is a list of {"name": ..., "formulas": {"folder_N_param": formula},
+    "settings": {...}}, formulas and settings both optional. The project is
+    loaded once, and the variants are exported one after another into
+    output_dir as <project>_<name>.<format>, so the samples, compiled
+    formulas, the render processes and the stems of folders a variant
+    doesn't change are shared between them. The stems the next variants are
+    missing are queued on the render processes together, up to
+    sweep_ahead_bytes of them, so the workers keep going between variants
+    and while the encoders finish. MIDI folders aren't part of a sweep.
+    Every variant's formulas are checked before any is rendered, and a
+    ValueError lists the ones that don't work. A variant that fails while
+    rendering gets an "error" in its summary and the sweep carries on. The
+    summaries are written to output_dir/sweep.json, also when the sweep is
+    interrupted.
+    """
+    project_audio_folders, _, settings = load_project(path)
+    name = os.path.splitext(os.path.basename(path))[0]
+    if output_dir is None:
+        ensure_exports_folder_exists()
+        current_time_str = datetime.now().strftime("%Y%m%d_%H%M%S")
+        output_dir = os.path.join(os.getcwd(), "exports", f"{name}_sweep_{current_time_str}")
+    variant_names = [str(variant.get("name", index + 1)) for index, variant in enumerate(variants)]
+    # Check every variant's formulas before spending time on any of them
+    problems = []
+    for variant_name, variant in zip(variant_names, variants):
+        try:
+            check_formula_overrides(project_audio_folders, variant.get("formulas", {}))
+        except Exception as error:
+            problems.append(f"{variant_name}: {type(error).__name__}: {error}")
+    if problems:
+        raise ValueError("Variants with formulas that don't work:\n" + "\n".join(problems))
+    os.makedirs(output_dir, exist_ok=True)
+
+    if workers is None:
+        workers = render_workers or os.cpu_count() or 1
+    frame_rate, _ = get_mix_format(project_audio_folders)
+    sounding = sounding_folders(project_audio_folders)
+    # Stems queued for an earlier variant that a later one doesn't need to queue again
+    pending_keys = set()
+
+    def queue_variant(variant):
+        """Queue the stems a variant is missing on the render processes, see submit_stems."""
+        duration_in_millis = int(dict(settings, **variant.get("settings", {}))["duration"] * 1000)
+        queued = {"jobs": [], "blocks": [], "keys": [], "reused": 0, "error": None}
+        replaced = apply_formula_overrides(project_audio_folders, variant.get("formulas", {}))
+        try:
+            plan = get_formula_plan(project_audio_folders)
+            queued["keys"] = [get_stem_key(plan, folder_index, duration_in_millis, frame_rate) for folder_index in range(len(project_audio_folders))]
+            missing = [folder for folder, stem_key in zip(project_audio_folders, queued["keys"]) if folder in sounding and stem_key not in stem_cache.entries and stem_key not in pending_keys]
+            queued["reused"] = sum(stem_key in stem_cache.entries or stem_key in pending_keys for stem_key in queued["keys"])
+            # A mix too long to hold is streamed by export_mix without stems
+            if workers > 1 and missing and render_mix_bytes(project_audio_folders, duration_in_millis, project_audio_folders, workers) <= export_buffer_bytes:
+                queued["jobs"] = submit_stems(get_render_pool(workers), missing, duration_in_millis, project_audio_folders, frame_rate, workers, queued["blocks"])
+                pending_keys.update(queued["keys"][project_audio_folders.index(folder)] for folder in missing)
+        except Exception as error:
+            # Reported when the variant's turn comes
+            queued["error"] = error
+        finally:
+            apply_formula_overrides(project_audio_folders, replaced)
+        return queued
+
+    def cache_stems(queued):
+        def cache_stem(folder, stem_buffer):
+            stem_key = queued["keys"][project_audio_folders.index(folder)]
+            pending_keys.discard(stem_key)
+            if stem_buffer.nbytes <= stem_cache.max_bytes:
+                stem_cache.put(stem_key, np.array(stem_buffer))
+        try:
+            collect_stems(queued["jobs"], cache_stem)
+        finally:
+            release_shared(queued["blocks"])
+
+    def drop_queued(queued):
+        for _, futures, _, _ in queued["jobs"]:
+            for future in futures:
+                future.cancel()
+        release_shared(queued["blocks"])
+
+    summary = []
+    queue = {}
+    next_index = 0
+    try:
+        for index, (variant_name, variant) in enumerate(zip(variant_names, variants)):
+            # Keep the render processes busy with the next variants' stems
+            while next_index == index or (workers > 1 and next_index < len(variants) and sum(block.size for queued in queue.values() for block in queued["blocks"]) < sweep_ahead_bytes):
+                queue[next_index] = queue_variant(variants[next_index])
+                next_index += 1
+            queued = queue.pop(index)
+            variant_settings = dict(settings, **variant.get("settings", {}))
+            started = perf_counter()
+            replaced = {}
+            try:
+                render_stats.reset()
+                if queued["error"] is not None:
+                    raise queued["error"]
+                cache_stems(queued)
+                replaced = apply_formula_overrides(project_audio_folders, variant.get("formulas", {}))
+                files = export_mix(project_audio_folders, variant_settings, os.path.join(output_dir, f"{name}_{variant_name}"), workers)
+                summary.append({
+                    "name": variant_name,
+                    "files": files,
+                    "seconds": perf_counter() - started,
+                    "stems_rendered": len(project_audio_folders) - queued["reused"],
+                    "stems_reused": queued["reused"],
+                })
+            except Exception as error:
+                summary.append({
+                    "name": variant_name,
+                    "error": f"{type(error).__name__}: {error}",
+                    "seconds": perf_counter() - started,
+                })
+            finally:
+                apply_formula_overrides(project_audio_folders, replaced)
+    finally:
+        for queued in queue.values():
+            drop_queued(queued)
+        with open(os.path.join(output_dir, "sweep.json"), "w") as summary_file:
+            json.dump(summary, summary_file, indent=4)
+    return summary
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Math based audio sequencer. Opens the GUI unless a command is given.")
+    commands = parser.add_subparsers(dest="command")
+    render_parser = commands.add_parser("render", help="Render project files without the GUI")
+    render_parser.add_argument("projects", nargs="+", help="Project files saved from the GUI")
+    render_parser.add_argument("-o", "--output", help="Output file, only with a single project (default: exports folder)")
+    render_parser.add_argument("--workers", type=int, help="Render processes per project (default: one per CPU core)")
+    render_parser.add_argument("--duration", type=float, help="Override the duration in seconds")
+    render_parser.add_argument("--format", nargs="+", choices=file_formats, help="Export these formats instead of the project's")
+    render_parser.add_argument("--bitrate", nargs="+", choices=bitrates, help="Export at these bitrates instead of the project's")
+    render_parser.add_argument("--sample-rate", nargs="+", choices=sample_rates, help="Export at these sample rates instead of the project's")
+    render_parser.add_argument("--stats", action="store_true", help="Write per-stage timings next to each output as .stats.json")
+    render_parser.add_argument("--score", help="Render the grains of this score file instead of evaluating the formulas")
+    score_parser = commands.add_parser("score", help="Save a project's grains as a score file and print their statistics")
+    score_parser.add_argument("project", help="Project file saved from the GUI")
+    score_parser.add_argument("-o", "--output", required=True, help="Score file to write (.npz)")
+    score_parser.add_argument("--duration", type=float, help="Override the duration in seconds")
+    sweep_parser = commands.add_parser("sweep", help="Render variants of a project with some formulas changed")
+    sweep_parser.add_argument("project", help="Project file saved from the GUI")
+    sweep_parser.add_argument("variants", help='JSON list of {"name": ..., "formulas": {"folder_1_spacing": ...}}')
+    sweep_parser.add_argument("-o", "--output", help="Folder for the variants (default: in the exports folder)")
+    sweep_parser.add_argument("--workers", type=int, help="Render processes (default: one per CPU core)")
+    sweep_parser.add_argument("--stats", action="store_true", help="Write per-stage timings next to each variant as .stats.json")
+    args = parser.parse_args(argv)
+
+    if args.command is None:
+        # Only the GUI needs wx
+        import gui
+        gui.run()
+        return 0
+
+    if args.command == "sweep":
+        if args.stats:
+            render_stats.enabled = True
+        with open(args.variants) as variants_file:
+            variants = json.load(variants_file)
+        try:
+            results = render_sweep(args.project, variants, args.output, args.workers)
+        except ValueError as error:
+            print(error, file=sys.stderr)
+            return 1
+        failed = 0
+        for result in results:
+            if "error" in result:
+                failed += 1
+                print(f"{result['name']}: failed after {result['seconds']:.2f} s, {result['error']}")
+                continue
+            reuse = f"{result['stems_reused']} of {result['stems_reused'] + result['stems_rendered']} stems reused"
+            print(f"{result['name']}: {result['seconds']:.2f} s, {reuse}, {', '.join(result['files'])}")
+        return 1 if failed else 0
+
+    if args.command == "score":
+        score = score_project(args.project, args.output, args.duration)
+        json.dump(score.describe(), sys.stdout, indent=4)
+        print()
+        return 0
+
+    if args.score and len(args.projects) > 1:
+        parser.error("--score needs a single project")
+    if args.output and len(args.projects) > 1:
+        parser.error("--output needs a single project")
+    if args.stats:
+        render_stats.enabled = True
+    # Each of these can take several values, every combination gets exported from one render
+    overrides = {key: getattr(args, key) for key in ("format", "bitrate", "sample_rate") if getattr(args, key)}
+    for path in args.projects:
+        for exported in render_project(path, args.output, workers=args.workers, duration=args.duration, overrides=overrides, score_path=args.score):
+            print(exported)
+    return 0
+
+if __name__ == "__main__":
+    # The GUI imports this file as _main_, share the module instead of loading it twice
+    sys.modules.setdefault("_main_", sys.modules[__name__])
+    sys.exit(main())
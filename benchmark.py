@@ -0,0 +1,249 @@
+"""Benchmarks for the render pipeline.
+
+Renders synthetic sample folders with representative formula sets and
+prints the results as JSON, so runs can be saved and compared over time:
+
+    python benchmark.py                          # every scenario
+    python benchmark.py dense reversed -o run.json
+    python benchmark.py --compare old.json -o new.json
+
+Each scenario runs in a fresh process so its peak RSS is its own. Stage
+times come from the engine's RenderStats, summed over the render processes
+when there are several, so they can add up to more than the render. With
+--workers above 1 every scenario's parallel render is also checked against
+a serial one, and the exit status is 1 if any differ.
+"""
+import os
+import sys
+import json
+import time
+import wave
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import multiprocessing
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+# Sample folders: (number of files, seconds per file, channels, frame rate)
+sample_sets = {
+    "stereo_44k": (8, 2.0, 2, 44100),
+    "mono_48k": (8, 2.0, 1, 48000),
+    "long_files": (4, 30.0, 2, 44100),
+}
+
+# Formulas see x as the time in seconds; start and duration are percentages of the sample
+scenarios = {
+    # Many short grains, the common case
+    "dense": {
+        "duration": 30000,
+        "folders": [("stereo_44k", {"spacing": "0.002", "duration": "4", "start": "x*10%95"})],
+    },
+    # Backwards at a handful of recurring speeds
+    "reversed": {
+        "duration": 30000,
+        "folders": [("stereo_44k", {"spacing": "0.005", "duration": "6", "playback_speed": "-(1 + x*10//1%3)/2", "start": "x*10%90"})],
+    },
+    # Every folder follows the one before it
+    "cross_folder": {
+        "duration": 30000,
+        "folders": [
+            ("stereo_44k", {"spacing": "0.01", "duration": "5", "start": "x*3%95", "panning": "x%2-1"}),
+            ("mono_48k", {"spacing": "folder_1_spacing*2", "duration": "folder_1_duration*2", "start": "folder_1_start*2%95", "panning": "-folder_1_panning"}),
+            ("stereo_44k", {"spacing": "folder_2_spacing/2", "duration": "folder_2_duration/2", "playback_speed": "1+folder_1_panning/2", "amplitude": "folder_2_amplitude/2"}),
+            ("mono_48k", {"spacing": "folder_3_spacing", "duration": "folder_1_duration+folder_2_start%5"}),
+        ],
+    },
+    # Ten minutes out of long source files, at continuously changing speeds
+    "long": {
+        "duration": 600000,
+        "folders": [("long_files", {"spacing": "0.02", "duration": "0.5", "start": "x*7%99", "playback_speed": "0.5+x%4/4"})],
+    },
+}
+
+midi_formulas = {"pitch": "48+x%24", "velocity": "64+x%32", "notelength": "50+x%150", "notespacing": "10"}
+
+def write_sample_folder(path, count, seconds, channels, frame_rate):
+    """Write `count` deterministic 16 bit noise-and-sine WAV files to path."""
+    os.makedirs(path, exist_ok=True)
+    rng = np.random.default_rng(count)
+    num_frames = int(seconds * frame_rate)
+    t = np.arange(num_frames) / frame_rate
+    for index in range(count):
+        tone = np.sin(2 * np.pi * (110 * (index + 1)) * t)[:, None]
+        noise = rng.uniform(-1, 1, (num_frames, channels))
+        samples = (0.5 * tone + 0.2 * noise) * 32767 * 0.8
+        with wave.open(os.path.join(path, f"sample_{index}.wav"), "wb") as wav_file:
+            wav_file.setnchannels(channels)
+            wav_file.setsampwidth(2)
+            wav_file.setframerate(frame_rate)
+            wav_file.writeframes(samples.astype("<i2").tobytes())
+
+def peak_rss_bytes():
+    try:
+        import resource
+    except ImportError:
+        return None  # Windows
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if platform.system() == "Darwin" else peak * 1024
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+def run_scenario(name, data_dir, repeat, workers):
+    """Run one scenario and return its results; called in a fresh process."""
+    import _main_ as engine
+
+    # A private sample cache, so decoding is measured and ./cache is left alone
+    engine.sample_library = engine.SampleLibrary(os.path.join(data_dir, "cache", name))
+    scenario = scenarios[name]
+    duration = scenario["duration"]
+
+    folders = []
+    stages = {"load": 0.0}
+    for sample_set, formulas in scenario["folders"]:
+        folder = engine.AudioFolder(os.path.join(data_dir, sample_set))
+        folder.formulas.update(formulas)
+        stages["load"] += timed(folder.load_audio_files)[0]
+        folders.append(folder)
+
+    plan = engine.get_formula_plan(folders)
+    num_grains = sum(len(engine.concatenate_batches(engine.iter_folder_batches(plan, index, duration))[0]) for index in range(len(folders)))
+    runs = []
+    for _ in range(repeat):
+        engine.invalidate_formula_plans()
+        engine.resampler.cache.clear()
+        engine.stem_cache.clear()
+        engine.grain_cache.clear()
+        # The stages as the render measures them, formulas, resample, gains and mix
+        engine.render_stats.enabled = True
+        engine.render_stats.reset()
+        run = {"render": timed(engine.render_mix, folders, duration, folders, False, workers)[0]}
+        engine.render_stats.enabled = False
+        for stage, stats in engine.render_stats.report()["stages"].items():
+            run[stage] = stats["total_seconds"]
+        runs.append(run)
+
+    best = {stage: min(run.get(stage, 0.0) for run in runs) for stage in dict.fromkeys(stage for run in runs for stage in run)}
+    stages.update(best)
+
+    # Parallel renders have to come out exactly like serial ones, sharded folders included
+    identical = None
+    if workers > 1:
+        renders = []
+        for count in (1, workers):
+            engine.invalidate_formula_plans()
+            engine.stem_cache.clear()
+            renders.append(engine.render_mix(folders, duration, folders, False, count)[0].buffer)
+        identical = bool(np.array_equal(*renders))
+    # This process is a pool worker itself, it hangs on exit while its render processes are still up
+    for pool in engine.render_pools.values():
+        pool.shutdown()
+
+    # Single calls of the AudioSegment helpers kept for library use
+    sample = folders[0].audio_files[0]
+    grain = sample.to_segment(sample.samples[:sample.frame_rate // 10])
+    midi_folder = engine.MidiFolder()
+    midi_folder.formulas.update(midi_formulas)
+    midi_path = os.path.join(data_dir, f"{name}.mid")
+    helpers = {
+        "apply_hann_window": timed(engine.apply_hann_window, grain, 0.5, 0.5)[0],
+        "time_playback_speed": timed(engine.time_playback_speed, grain, -1.5)[0],
+        "pan_gains": timed(engine.pan_gains, 0.25)[0],
+        "generate_midi_based_on_formula": timed(engine.generate_midi_based_on_formula, duration, [midi_folder], midi_path)[0],
+    }
+
+    return {
+        "duration_seconds": duration / 1000,
+        "folders": len(folders),
+        "grains": num_grains,
+        "repeat": repeat,
+        "workers": workers,
+        "grains_per_second": num_grains / best["render"] if best["render"] else None,
+        "realtime_factor": (duration / 1000) / best["render"] if best["render"] else None,
+        "identical_to_serial": identical,
+        "stage_seconds": stages,
+        "helper_seconds": helpers,
+        "peak_rss_bytes": peak_rss_bytes(),
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def machine_info():
+    return {
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "cpu_count": os.cpu_count(),
+    }
+
+def compare(previous, current):
+    """Print the realtime factor of each scenario against a previous run."""
+    for name, result in current["scenarios"].items():
+        before = previous.get("scenarios", {}).get(name)
+        if not before or not before.get("realtime_factor") or not result["realtime_factor"]:
+            print(f"{name}: {result['realtime_factor']:.1f}x realtime (no previous run)", file=sys.stderr)
+            continue
+        change = result["realtime_factor"] / before["realtime_factor"]
+        print(f"{name}: {result['realtime_factor']:.1f}x realtime, {change:.2f}x the previous run", file=sys.stderr)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("scenarios", nargs="*", help=f"Scenarios to run: {', '.join(scenarios)} (default: all)")
+    parser.add_argument("-o", "--output", help="Write the JSON results here instead of stdout")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per scenario, the fastest counts")
+    parser.add_argument("--workers", type=int, default=1, help="Render processes (default: 1, for comparable numbers)")
+    parser.add_argument("--compare", help="Previous JSON results to compare against")
+    parser.add_argument("--data-dir", help="Where the synthetic samples go (default: a temporary folder)")
+    args = parser.parse_args(argv)
+    for name in args.scenarios:
+        if name not in scenarios:
+            parser.error(f"unknown scenario {name!r}")
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="deining-benchmark-")
+    try:
+        for sample_set, spec in sample_sets.items():
+            if not os.path.isdir(os.path.join(data_dir, sample_set)):
+                write_sample_folder(os.path.join(data_dir, sample_set), *spec)
+
+        results = {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "machine": machine_info(),
+            "scenarios": {},
+        }
+        for name in args.scenarios or scenarios:
+            # A fresh process per scenario, so peak RSS and caches don't carry over
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+                results["scenarios"][name] = pool.submit(run_scenario, name, data_dir, args.repeat, args.workers).result()
+    finally:
+        if not args.data_dir:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    differing = [name for name, result in results["scenarios"].items() if result["identical_to_serial"] is False]
+    if differing:
+        print(f"{', '.join(differing)}: parallel render differs from the serial one", file=sys.stderr)
+    if args.compare:
+        with open(args.compare) as previous_file:
+            compare(json.load(previous_file), results)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=4)
+    else:
+        json.dump(results, sys.stdout, indent=4)
+        print()
+    return 1 if differing else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,366 @@
+import os
+from datetime import datetime
+import wx
+# The GUI works on the engine's folders and render functions
+import _main_ as engine
+
+class AppFrame(wx.Frame):
+
+    def add_new_folder(self, event):
+        dialog = wx.DirDialog(self, "Choose a directory:", style=wx.DD_DEFAULT_STYLE)
+        if dialog.ShowModal() == wx.ID_OK:
+            path = dialog.GetPath()
+            new_folder = engine.AudioFolder(path)
+            self.start_loading(new_folder)
+            engine.audio_folders.append(new_folder)
+            engine.current_folder = new_folder
+            self.folder_listbox.Append(os.path.basename(path))
+            self.folder_listbox.SetSelection(self.folder_listbox.GetCount() - 1)  # Select the last added entry
+            self.update_display()
+        dialog.Destroy()
+
+    def start_loading(self, folder):
+        # Samples load in the background, the folder plays with whatever is in already
+        loader = engine.FolderLoader(folder,
+                                     on_progress=lambda done, total, name=os.path.basename(folder.path): wx.CallAfter(self.SetStatusText, f"Loading {name}: {done}/{total}"),
+                                     on_finish=lambda loader: wx.CallAfter(self.folder_loaded, loader))
+        self.loaders.append(loader)
+        loader.start()
+
+    def folder_loaded(self, loader):
+        if loader in self.loaders:
+            self.loaders.remove(loader)
+        name = os.path.basename(loader.folder.path)
+        done, total = loader.progress()
+        status = f"Loaded {len(loader.folder.audio_files)} samples from {name}"
+        if loader.cancelled.is_set():
+            status += f", cancelled after {done} of {total} files"
+        if not loader.folder.audio_files:
+            status += ", it stays silent"
+        self.SetStatusText(status)
+        if loader.errors:
+            skipped = "\n".join(f"{os.path.basename(path)}: {message}" for path, message in loader.errors[:20])
+            wx.MessageBox(f"Skipped {len(loader.errors)} files in {name} that couldn't be read:\n\n{skipped}", 'Warning', wx.OK | wx.ICON_WARNING)
+
+    def cancel_loading(self, event):
+        for loader in self.loaders:
+            loader.cancel()
+
+    def add_new_midi_folder(self, event):
+        new_midi_folder = engine.MidiFolder()
+        engine.midi_folders.append(new_midi_folder)
+        engine.current_folder = new_midi_folder
+        self.folder_listbox.Append("MIDI")
+        self.folder_listbox.SetSelection(self.folder_listbox.GetCount() - 1)  # Select the last added entry
+        self.update_display(midi=True)
+
+
+    def update_formula(self, param, event):
+        if self.updating_programmatically:
+            return
+
+        if engine.current_folder:
+            formula = self.entries[param].GetValue().strip()
+            previous_formula = engine.current_folder.formulas.get(param)
+            if previous_formula != formula:
+                engine.current_folder.formulas[param] = formula
+                # Recompile the evaluation plan on the next render
+                engine.invalidate_formula_plans()
+                if previous_formula is not None:
+                    engine.formula_cache.invalidate(previous_formula)
+            self.update_display()
+
+
+    def update_display(self, midi=False):
+        if midi:
+            # Update UI for MIDI-specific parameters
+            self.updating_programmatically = True
+            for param in engine.midi_parameters:  # Assume midi_parameters is a list of MIDI-specific parameters
+                formula = engine.current_folder.formulas.get(param, "")  # Use current_folder, which now can be a MidiFolder
+                self.entries[param].SetValue(formula)
+            self.updating_programmatically = False
+        else:
+            if engine.current_folder:
+                self.updating_programmatically = True
+                for param in engine.parameters:
+                    formula = engine.current_folder.formulas.get(param, "")
+                    self.entries[param].SetValue(formula)
+                self.updating_programmatically = False
+
+
+
+    def switch_folder(self, event):
+        try:
+            index = self.folder_listbox.GetSelection()
+            if self.folder_listbox.GetString(index) == "MIDI":
+                # Hide audio parameters and show MIDI parameters
+                for hbox in self.audio_boxes:
+                    hbox.ShowItems(False)
+                for hbox in self.midi_boxes:
+                    hbox.ShowItems(True)
+            else:
+                # Hide MIDI parameters and show audio parameters
+                for hbox in self.audio_boxes:
+                    hbox.ShowItems(True)
+                for hbox in self.midi_boxes:
+                    hbox.ShowItems(False)
+
+            self.audio_vbox.Layout()  # Explicitly update layout
+            self.midi_vbox.Layout()  # Explicitly update layout
+
+            self.Layout()  # Refresh layout
+            self.Fit()  # Adjust to content size
+            # self.Refresh()
+            # self.update_display(midi=(self.folder_listbox.GetString(index) == "MIDI"))
+        except Exception as e:
+            print(f"An error occurred: {e}")
+
+
+
+
+
+    def export(self, event):
+        if self.loaders:
+            # Grains pick samples by index, a partial folder would pick different files
+            wx.MessageBox("Samples are still loading. Wait for them to finish or press Cancel Load, then export.", 'Warning', wx.OK | wx.ICON_WARNING)
+            return
+        engine.ensure_exports_folder_exists()
+        settings = self.get_settings()
+
+        current_time_str = datetime.now().strftime("%Y%m%d_%H%M%S")
+        exports_path = os.path.join(os.getcwd(), "exports")
+        filename = os.path.join(exports_path, f"combined_output_{current_time_str}")
+        
+        if engine.midi_folders:
+            engine.generate_midi_based_on_formula(int(settings["duration"] * 1000), engine.midi_folders, f"{current_time_str}.mid")
+
+        engine.render_stats.enabled = self.stats_checkbox.GetValue()
+        engine.render_stats.reset()
+        exported = engine.export_mix(engine.audio_folders, settings, filename)
+        message = "Audio files combined and saved as " + ", ".join(f"'{path}'" for path in exported)
+        if engine.render_stats.enabled:
+            message += f"\n\n{engine.render_stats.summary()}\n\nFull report: {filename}.stats.json"
+        wx.MessageBox(message, 'Info', wx.OK | wx.ICON_INFORMATION)
+
+    def get_settings(self):
+        return {
+            "duration": self.duration_spin.GetValue(),
+            "format": self.get_selected(self.format_list, "format"),
+            "bitrate": self.get_selected(self.bitrate_list, "bitrate"),
+            "sample_rate": self.get_selected(self.sample_rate_list, "sample_rate"),
+        }
+
+    def get_selected(self, listbox, key):
+        # Every selected value gets exported, nothing selected means the default
+        return [listbox.GetString(index) for index in listbox.GetSelections()] or [engine.default_settings[key]]
+
+    def save_project(self, event):
+        dialog = wx.FileDialog(self, "Save project", wildcard="Deining projects (*.json)|*.json", style=wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT)
+        if dialog.ShowModal() == wx.ID_OK:
+            engine.save_project(dialog.GetPath(), engine.audio_folders, engine.midi_folders, self.get_settings())
+        dialog.Destroy()
+
+    def open_project(self, event):
+        dialog = wx.FileDialog(self, "Open project", wildcard="Deining projects (*.json)|*.json", style=wx.FD_OPEN | wx.FD_FILE_MUST_EXIST)
+        if dialog.ShowModal() == wx.ID_OK:
+            loaded_audio_folders, loaded_midi_folders, settings = engine.load_project(dialog.GetPath(), load_samples=False)
+            self.cancel_loading(None)
+            for folder in loaded_audio_folders:
+                self.start_loading(folder)
+            # Replace the contents, the engine holds on to these lists
+            engine.audio_folders[:] = loaded_audio_folders
+            engine.midi_folders[:] = loaded_midi_folders
+            engine.invalidate_formula_plans()
+
+            self.folder_listbox.Clear()
+            for folder in engine.audio_folders:
+                self.folder_listbox.Append(os.path.basename(folder.path))
+            for folder in engine.midi_folders:
+                self.folder_listbox.Append("MIDI")
+            self.duration_spin.SetValue(int(settings["duration"]))
+            for listbox, key in ((self.format_list, "format"), (self.bitrate_list, "bitrate"), (self.sample_rate_list, "sample_rate")):
+                listbox.SetSelection(wx.NOT_FOUND)
+                for value in engine.as_list(settings[key]):
+                    listbox.SetStringSelection(str(value))
+
+            engine.current_folder = engine.audio_folders[0] if engine.audio_folders else None
+            if engine.current_folder:
+                self.folder_listbox.SetSelection(0)
+                self.update_display()
+        dialog.Destroy()
+
+
+    def __init__(self, parent, title):
+        super(AppFrame, self).__init__(parent, title=title, size=(900, 600))
+        self.player = None
+        self.loaders = []
+        self.InitUI()
+
+    def play_audio(self, event):
+        self.stop_audio(event)
+        duration = self.duration_spin.GetValue()
+        if self.draft_checkbox.GetValue():
+            # A quick draft from the playhead first, full quality follows while it plays
+            start_millis = int(self.playhead_spin.GetValue() * 1000)
+            self.player = engine.PreviewPlayer(engine.audio_folders, engine.audio_folders, int(duration * 1000), start_millis=start_millis, on_finish=self.player_finished)
+            self.player.start()
+            self.SetStatusText("Playing a draft, refining in the background")
+            return
+        # Formula edits are picked up while playing
+        self.player = engine.LivePlayer(engine.audio_folders, engine.audio_folders, int(duration * 1000), on_finish=self.player_finished)
+        self.player.start()
+        self.SetStatusText(f"Playing, {self.player.latency_millis():.0f} ms latency")
+
+    def stop_audio(self, event):
+        if self.player is not None:
+            self.player.stop()
+
+    def player_finished(self, player):
+        # Called from the player's thread
+        report = player.report()
+        status = f"Played {report['played_seconds']:.1f} s, {report['underruns']} underruns"
+        if report.get("quality"):
+            status += f", reached {report['quality']} quality"
+        if report.get("last_error"):
+            status += f", last formula error: {report['last_error']}"
+        wx.CallAfter(self.SetStatusText, status)
+
+    def make_lambda(p):
+        return lambda event: self.update_formula(p, event)
+
+    def InitUI(self):
+        panel = wx.Panel(self)
+        vbox = wx.BoxSizer(wx.VERTICAL)
+        
+        
+        # Top layout
+        hbox1 = wx.BoxSizer(wx.HORIZONTAL)
+
+        # Add Folder button
+        select_button = wx.Button(panel, label='Add Audio')
+        select_button.Bind(wx.EVT_BUTTON, self.add_new_folder)
+        hbox1.Add(select_button, flag=wx.RIGHT, border=10)
+
+        cancel_load_button = wx.Button(panel, label='Cancel Load')
+        cancel_load_button.Bind(wx.EVT_BUTTON, self.cancel_loading)
+        hbox1.Add(cancel_load_button, flag=wx.RIGHT, border=10)
+
+        select_midi_button = wx.Button(panel, label='Add MIDI')
+        select_midi_button.Bind(wx.EVT_BUTTON, self.add_new_midi_folder)
+        hbox1.Add(select_midi_button, flag=wx.RIGHT, border=10)
+
+        # Duration label and spinbox
+        duration_label = wx.StaticText(panel, label='Duration:')
+        hbox1.Add(duration_label, flag=wx.RIGHT, border=10)
+
+        self.duration_spin = wx.SpinCtrl(panel, value='120', min=1, max=10000)
+        hbox1.Add(self.duration_spin, flag=wx.RIGHT, border=10)
+
+        seconds_label = wx.StaticText(panel, label='s')
+        hbox1.Add(seconds_label, flag=wx.RIGHT, border=10)
+
+        # Lists for format, bitrate, and sample rate, every combination of the selected ones is exported
+        self.format_list = wx.ListBox(panel, choices=engine.file_formats, style=wx.LB_MULTIPLE, size=(70, 60))
+        hbox1.Add(self.format_list, flag=wx.RIGHT, border=10)
+
+        self.bitrate_list = wx.ListBox(panel, choices=engine.bitrates, style=wx.LB_MULTIPLE, size=(70, 60))
+        hbox1.Add(self.bitrate_list, flag=wx.RIGHT, border=10)
+
+        self.sample_rate_list = wx.ListBox(panel, choices=engine.sample_rates, style=wx.LB_MULTIPLE, size=(70, 60))
+        hbox1.Add(self.sample_rate_list, flag=wx.RIGHT, border=10)
+
+        self.playback_button = wx.Button(panel, label='Play')
+        self.playback_button.Bind(wx.EVT_BUTTON, self.play_audio)
+        hbox1.Add(self.playback_button, flag=wx.RIGHT, border=10)  # Added border here
+
+        # Draft playback from the playhead, see PreviewPlayer
+        self.draft_checkbox = wx.CheckBox(panel, label='Draft from')
+        hbox1.Add(self.draft_checkbox, flag=wx.RIGHT | wx.ALIGN_CENTER_VERTICAL, border=5)
+
+        self.playhead_spin = wx.SpinCtrl(panel, value='0', min=0, max=10000, size=(60, -1))
+        hbox1.Add(self.playhead_spin, flag=wx.RIGHT, border=10)
+
+        stop_button = wx.Button(panel, label='Stop')
+        stop_button.Bind(wx.EVT_BUTTON, self.stop_audio)
+        hbox1.Add(stop_button, flag=wx.RIGHT, border=10)
+
+        # Export button
+        export_button = wx.Button(panel, label='Export')
+        export_button.Bind(wx.EVT_BUTTON, self.export)
+        hbox1.Add(export_button, flag=wx.RIGHT, border=10)
+
+        # Time the render stages of exports
+        self.stats_checkbox = wx.CheckBox(panel, label='Stats')
+        hbox1.Add(self.stats_checkbox, flag=wx.RIGHT | wx.ALIGN_CENTER_VERTICAL, border=10)
+
+        # Project buttons
+        save_button = wx.Button(panel, label='Save')
+        save_button.Bind(wx.EVT_BUTTON, self.save_project)
+        hbox1.Add(save_button, flag=wx.RIGHT, border=10)
+
+        open_button = wx.Button(panel, label='Open')
+        open_button.Bind(wx.EVT_BUTTON, self.open_project)
+        hbox1.Add(open_button)
+
+        vbox.Add(hbox1, flag=wx.EXPAND|wx.LEFT|wx.RIGHT|wx.TOP, border=10)
+
+        # Folder listbox
+        self.folder_listbox = wx.ListBox(panel)
+        self.folder_listbox.Bind(wx.EVT_LISTBOX, self.switch_folder)
+        vbox.Add(self.folder_listbox, proportion=1, flag=wx.EXPAND|wx.LEFT|wx.RIGHT|wx.TOP, border=10)
+
+        self.format_list.SetSelection(0)  # Default to 'wav'
+        self.bitrate_list.SetSelection(1)  # Default to '128k'
+        self.sample_rate_list.SetSelection(1)  # Default to '44100'
+
+        self.audio_vbox = wx.BoxSizer(wx.VERTICAL)
+        self.midi_vbox = wx.BoxSizer(wx.VERTICAL)
+
+        # Parameters entries
+        self.entries = {}
+        self.audio_boxes = []  # List to hold audio parameter boxes
+        self.midi_boxes = []  # List to hold MIDI parameter boxes
+
+        for param in engine.parameters:  # Loop for audio parameters
+            hbox = wx.BoxSizer(wx.HORIZONTAL)
+            label = wx.StaticText(panel, label=param.capitalize())
+            hbox.Add(label, flag=wx.RIGHT, border=10)
+            entry = wx.TextCtrl(panel, size=(200, -1))
+            entry.Bind(wx.EVT_TEXT, lambda event, p=param: self.update_formula(p, event))
+            hbox.Add(entry)
+            self.entries[param] = entry
+            self.audio_boxes.append(hbox)
+            self.audio_vbox.Add(hbox, flag=wx.EXPAND|wx.LEFT|wx.RIGHT|wx.TOP, border=10)
+            hbox.ShowItems(True)  # Hide MIDI parameters initially
+
+        for param in engine.midi_parameters:  # Loop for MIDI parameters
+            hbox = wx.BoxSizer(wx.HORIZONTAL)
+            label = wx.StaticText(panel, label=param.capitalize())
+            hbox.Add(label, flag=wx.RIGHT, border=10)
+            entry = wx.TextCtrl(panel, size=(200, -1))
+            entry.Bind(wx.EVT_TEXT, lambda event, p=param: self.update_formula(p, event))
+            hbox.Add(entry)
+            self.entries[param] = entry
+            self.midi_boxes.append(hbox)
+            self.midi_vbox.Add(hbox, flag=wx.EXPAND|wx.LEFT|wx.RIGHT|wx.TOP, border=10)
+            hbox.ShowItems(True)  # Hide MIDI parameters initially
+
+        # Add audio and MIDI vertical box sizers to the main vertical box sizer
+        vbox.Add(self.audio_vbox, flag=wx.EXPAND|wx.LEFT|wx.RIGHT|wx.TOP, border=10)
+        vbox.Add(self.midi_vbox, flag=wx.EXPAND|wx.LEFT|wx.RIGHT|wx.TOP, border=10)
+
+        panel.SetSizer(vbox)
+        self.updating_programmatically = False
+
+        self.CreateStatusBar()
+        self.Centre()
+        self.Show(True)
+
+
+def run():
+    app = wx.App()
+    AppFrame(None, 'Deining.V1')
+    app.MainLoop()
+
+if __name__ == "__main__":
+    run()